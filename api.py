@@ -0,0 +1,620 @@
+"""Python API to operate the Lima VM and the virtual clusters in-process.
+
+The click commands are thin wrappers over these functions. Failures raise the errors in
+`helpers.exceptions` instead of aborting, and every function has an `*_async` variant
+which runs it in a thread so that many clusters can be operated concurrently:
+
+    import api
+
+    config = api.Config.from_environment()
+    clusters = await asyncio.gather(
+        *[api.create_virtual_cluster_async(config, f"test-{i}", switch_context=False) for i in range(20)]
+    )
+"""
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import urllib.error
+
+import yaml
+import helpers.checkpoint_helper as checkpoints
+import helpers.cluster_helper as cluster
+import helpers.completion_helper as completion
+import helpers.registry_helper as registry
+import helpers.shell_helper as sh
+import helpers.snapshot_helper as snapshots
+import helpers.vm_helper as vmh
+from helpers.exceptions import (
+    BinaryNotFoundError,
+    CommandError,
+    FieldctlError,
+    SnapshotNotFoundError,
+    VirtualClusterNotFoundError,
+    VMNotFoundError,
+    WaitTimeoutError,
+)
+
+logger = logging.getLogger('root')
+
+VCLUSTER_IMAGE = "rancher/k3s:v1.22.5-k3s1"
+RETRY_ATTEMPTS = 5
+EXPOSE_MODES = cluster.EXPOSE_MODES
+RETRY_BASE_SECONDS = 2
+RETRY_MAX_SECONDS = 30
+# Full or short ID of a local image. i.e. `sha256:4f2e...` or `4f2e5c7a9b1d`
+IMAGE_ID_PATTERN = r"(sha256:)?[0-9a-f]{12,64}"
+
+# Keys of the click context object for each Config field
+_CTX_KEYS = {
+    "main_context": "MAIN_CONTEXT",
+    "persisted_folder": "PERSISTED_FOLDER",
+    "default_kubeconfig": "DEFAULT_KUBECONFIG",
+    "default_port_forward": "DEFAULT_PORT_FORWARD",
+    "guest_registry_folder": "GUEST_REGISTRY_FOLDER",
+    "provision_folder": "PROVISION_FOLDER",
+    "lima_template": "LIMA_TEMPLATE",
+    "local_registry": "LOCAL_REGISTRY",
+}
+
+
+@dataclasses.dataclass
+class Config:
+    main_context: str
+    persisted_folder: str
+    default_kubeconfig: str
+    provision_folder: str
+    lima_template: str
+    default_port_forward: int = 11443
+    guest_registry_folder: str = "/var/lib/fieldctl/registry/data"
+    # `k3s-local-registry` in the VM. Lima forwards its port to the host
+    local_registry: str = "127.0.0.1:5005"
+
+    @classmethod
+    def from_environment(cls, main_context="field-main"):
+        home = os.environ.get("HOME")
+        # The binary built with pyinstaller deploys the provision folder in a temporary folder
+        base_path = getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__)))
+        return cls(
+            main_context=main_context,
+            persisted_folder=home + "/.field",
+            default_kubeconfig=home + "/.kube/config",
+            provision_folder=vmh.get_path_to_provision(base_path),
+            lima_template=vmh.get_path_to_lima_template(base_path),
+        )
+
+    @classmethod
+    def from_ctx(cls, ctx):
+        return cls(**{field: ctx[key] for field, key in _CTX_KEYS.items()})
+
+    def to_ctx(self):
+        # The helpers expect the click context object
+        return {key: getattr(self, field) for field, key in _CTX_KEYS.items()}
+
+
+@dataclasses.dataclass
+class VM:
+    name: str
+    status: str
+    cpus: int = None
+    memory: int = None
+    disk: int = None
+
+
+@dataclasses.dataclass
+class LoadImagesResult:
+    # References to pull the images from the clusters
+    images: list
+    pushed_blobs: int
+    skipped_blobs: int
+    bytes_transferred: int
+
+
+@dataclasses.dataclass
+class VirtualCluster:
+    name: str
+    namespace: str
+    status: str
+    context: str = None
+
+
+def _require(*binaries):
+    for binary in binaries:
+        if not sh.binary_exist(binary):
+            raise BinaryNotFoundError(f"You need to install {binary}")
+
+def _to_vm(data):
+    return VM(
+        name=data["name"],
+        status=data.get("status"),
+        cpus=data.get("cpus"),
+        memory=data.get("memory"),
+        disk=data.get("disk"),
+    )
+
+def _to_virtual_cluster(data, context=None):
+    return VirtualCluster(
+        name=data["Name"],
+        namespace=data.get("Namespace"),
+        status=data.get("Status"),
+        context=context,
+    )
+
+def _wait(condition, timeout_seconds, message):
+    # Poll every second until the condition returns a value or timeout
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        result = condition()
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            raise WaitTimeoutError(message)
+        time.sleep(1)
+
+
+#### VM ####
+
+def list_vms(use_cache=True):
+    _require("limactl")
+    return [_to_vm(i) for i in vmh.get_vms(use_cache)]
+
+def get_vm(config, use_cache=True):
+    for vm in list_vms(use_cache):
+        if vm.name == config.main_context:
+            return vm
+    raise VMNotFoundError("VM does not exist. Create it")
+
+def wait_vm(config, status="Running", timeout_seconds=300):
+    return _wait(
+        lambda: (lambda vm: vm if vm.status == status else None)(get_vm(config, use_cache=False)),
+        timeout_seconds,
+        f"Timeout. VM is not {status} after {timeout_seconds} seconds",
+    )
+
+def _retry(func, description, attempts=None):
+    # Bounded exponential backoff for transient failures (i.e. network pulls)
+    attempts = attempts or RETRY_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except CommandError as e:
+            if attempt == attempts:
+                raise
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+            logger.warning(f"{description} failed (attempt {attempt}/{attempts}). Retrying in {delay} seconds")
+            logger.debug(e)
+            time.sleep(delay)
+
+def _file_hash(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def _checkpoint_path(config):
+    return os.path.join(config.persisted_folder, f"{config.main_context}-create.checkpoint.json")
+
+def create_vm(config, cpus=4, disk=50, memory=8, io_profile="default", registry_storage="host",
+              cache_max_size=0, connect=False, kubeconfig=None, resume=False):
+    """Create the VM phase by phase.
+
+    Every completed phase is recorded in a checkpoint file. With resume, phases which are completed and still
+    valid are skipped. The checkpoint is removed once the VM is created
+    """
+    _require("limactl")
+    ctx = config.to_ctx()
+    filename = f"/tmp/{config.main_context}.yaml"
+    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
+    checkpoint_path = _checkpoint_path(config)
+    params = {
+        "cpus": str(cpus), "disk": str(disk), "memory": str(memory),
+        "io_profile": io_profile, "registry_storage": registry_storage,
+    }
+    checkpoint = checkpoints.load(checkpoint_path) if resume else None
+    if checkpoint is None:
+        if resume:
+            logger.warning("No checkpoint found. All the phases will run again. An existing VM is started instead of created")
+        checkpoint = checkpoints.new(params)
+    elif checkpoint["params"] != params:
+        raise FieldctlError(
+            f"The VM creation was started with different values: {checkpoint['params']}. Resume with the same values or start from scratch:\n\n\tfieldctl vm rm\n\tfieldctl vm create"
+        )
+
+    def copy():
+        logger.info(f"Persisted data will be created in {config.persisted_folder}")
+        # Copy the provision folder into the fodler which will be persisted into the VM. This is `~/.field`
+        vmh.copy_persisted_folder(config.provision_folder, config.persisted_folder)
+
+    def render():
+        # Copy the template to a temporary location and update its values to include port, resources and persisted folder
+        shutil.copy(config.lima_template, filename)
+        vmh.update_allocated_resources(ctx, filename, cpus, disk, memory)
+        vmh.add_home_persisted_folder(ctx, filename, io_profile)
+        vmh.set_registry_storage(ctx, filename, registry_storage)
+        vmh.add_forwarded_port(ctx, filename)
+        return {"sha256": _file_hash(filename)}
+
+    def validate():
+        # Validate the configuration works
+        returncode, out = sh.run_command(f"limactl validate {filename} --debug")
+        if returncode != 0:
+            raise CommandError("Error validating the VM", returncode, out)
+        return {"sha256": _file_hash(filename)}
+
+    def start():
+        # A previous attempt might have created the instance already
+        if resume and vmh.vm_exist(config.main_context):
+            logger.info(f"Start the existing Lima VM with name: {config.main_context}")
+            target = config.main_context
+        else:
+            logger.info(f"Create the Lima VM with name: {config.main_context}")
+            target = filename
+        returncode, out = sh.run_command(f"limactl start --tty=false {target}", show_output=True)
+        if returncode != 0:
+            raise CommandError("Error creating the machine", returncode)
+
+    def deploy_caches():
+        logger.info(
+            f"Install cache registries. This happens here since it cannot be done in provision scripts"
+        )
+        # Install docker registry caches (grc, quay, k8s, docker). The context of this fodler is persisted in `~\fieldctl`
+        def run():
+            returncode, out = vmh.run_persisted_script(config.main_context, "deploy-caches.sh")
+            if returncode != 0:
+                raise CommandError("Error creating registries", returncode, out)
+            # The script exits with the status of its last command. A failed `nerdctl run` (i.e. pulling registry:2) is only noticed here
+            if not vmh.caches_running(config.main_context):
+                raise CommandError("Error creating registries. Not all of them are running", returncode, out)
+        _retry(run, "Deploying the registries")
+
+    def prune():
+        # Keep the registry mirrors under the given size
+        logger.info(f"Prune registry mirrors to {vmh.format_size(cache_max_size)}")
+        returncode, out = vmh.prune_caches(config.main_context, max_size=cache_max_size)
+        if returncode != 0:
+            logger.warning("Error pruning registries. Run `fieldctl vm cache prune` to try again")
+            logger.warning(out)
+
+    def connect_main_cluster():
+        # Connect to the k3s (main cluster) provisioned in the VM.
+        # The kubeconfig file will be updated with te new details for the main cluster context
+        _retry(lambda: connect_vm(config, kubeconfig), "Fetching the kubeconfig")
+
+    rendered = lambda phase: _file_hash(filename) == checkpoints.get_phase(checkpoint, phase).get("sha256")
+    vm_running = lambda: any(vm.name == config.main_context and vm.status == "Running" for vm in list_vms(use_cache=False))
+    # (name, run, verify that the completed phase is still valid)
+    phases = [
+        ("copy", copy, lambda: os.path.isfile(os.path.join(config.persisted_folder, "deploy-caches.sh"))),
+        ("render", render, lambda: rendered("render")),
+        ("validate", validate, lambda: rendered("validate")),
+        ("start", start, vm_running),
+        ("deploy-caches", deploy_caches, lambda: vmh.caches_running(config.main_context)),
+    ]
+    if cache_max_size:
+        phases.append(("prune", prune, lambda: True))
+    if connect:
+        phases.append(("connect", connect_main_cluster, lambda: config.main_context in cluster.get_contexts(kubeconfig_path)))
+
+    for phase, run, verify in phases:
+        if checkpoints.is_completed(checkpoint, phase) and verify():
+            logger.info(f"Skip phase `{phase}`. It is already completed")
+            continue
+        data = run() or {}
+        checkpoints.complete(checkpoint_path, checkpoint, phase, **data)
+
+    checkpoints.clear(checkpoint_path)
+    return get_vm(config)
+
+def start_vm(config):
+    get_vm(config)
+    returncode, out = sh.run_command(f"limactl start --tty=false {config.main_context}", show_output=True)
+    if returncode != 0:
+        raise CommandError("Error starting the VM", returncode, out)
+    return get_vm(config)
+
+def stop_vm(config):
+    get_vm(config)
+    returncode, out = sh.run_command(f"limactl stop {config.main_context}", show_output=True)
+    if returncode != 0:
+        raise CommandError("Error stopping the VM", returncode, out)
+    return get_vm(config)
+
+def connect_vm(config, kubeconfig=None):
+    """Merge the kubeconfig of the main cluster. Returns the path to the updated kubeconfig"""
+    get_vm(config)
+    ctx = config.to_ctx()
+    logger.info("Download kubeconfig from VM and mergng into the current one")
+    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
+    cluster.connect_to_main_cluster(ctx, kubeconfig_path)
+    return kubeconfig_path
+
+def delete_vm(config, kubeconfig=None):
+    get_vm(config)
+    returncode, out = sh.run_command(f"limactl rm {config.main_context} -f")
+    if returncode != 0:
+        raise CommandError("Error deleting the VM", returncode, out)
+    checkpoints.clear(_checkpoint_path(config))
+    kubeconfig_path = cluster.get_current_kubeconfig_path(config.to_ctx(), kubeconfig)
+    cluster.remove_context_from_kubeconfig(kubeconfig_path, config.main_context)
+
+
+def load_images(config, images=(), from_dir=None, engine="docker", parallel=4):
+    """Push images into the local registry of the VM.
+
+    images are saved from the local image store of engine (docker, nerdctl, podman). from_dir loads the
+    archives (`docker save`) of the folder. Blobs which are already in the registry are not sent again
+    """
+    if parallel < 1:
+        raise FieldctlError(f"parallel must be at least 1, got {parallel}")
+    if images:
+        _require(engine)
+    archives = []
+    if from_dir:
+        archives = sorted(
+            os.path.join(from_dir, i) for i in os.listdir(from_dir) if i.endswith(".tar")
+        )
+    if not images and not archives:
+        raise FieldctlError("No images to load")
+    tmp_folder = tempfile.mkdtemp(prefix="fieldctl-images-")
+    pusher = registry.Pusher(config.local_registry)
+
+    def save(image):
+        # Unique name. Images are saved concurrently
+        fd, archive = tempfile.mkstemp(
+            prefix=f"{image.replace('/', '_').replace(':', '_')}-", suffix=".tar", dir=tmp_folder
+        )
+        os.close(fd)
+        returncode, out = sh.run_command(f"{engine} save -o {archive} {image}")
+        if returncode != 0:
+            raise CommandError(f"Error saving image {image}", returncode, out)
+        return archive
+
+    def load(image=None, archive=None):
+        archive = archive or save(image)
+        found = registry.read_archive(archive)
+        if image:
+            # Keep only the requested tag when the image was saved by reference. i.e. `my-app` is `my-app:latest`
+            matching = [i for i in found if registry.split_reference(i[0]) == registry.split_reference(image)]
+            # Saved by ID: all the tags belong to the same image
+            if re.fullmatch(IMAGE_ID_PATTERN, image) and len({image_config["digest"] for _, image_config, _ in found}) == 1:
+                matching = found
+            found = matching
+        loaded = []
+        for reference, image_config, layers in found:
+            logger.info(f"Push {reference}")
+            loaded.append(pusher.push(archive, reference, image_config, layers))
+        if not loaded:
+            # The registry needs a name. i.e. images saved by ID have no tags
+            raise FieldctlError(
+                f"No tagged image matching {image} in its archive. Tag it and load it by name" if image
+                else f"No tagged image in {archive}"
+            )
+        return loaded
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [executor.submit(load, image=i) for i in images]
+            futures += [executor.submit(load, archive=i) for i in archives]
+            loaded = [reference for future in futures for reference in future.result()]
+    except urllib.error.URLError as e:
+        raise CommandError(f"Error pushing to the local registry {config.local_registry}. Is the VM running?", output=str(e))
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    return LoadImagesResult(
+        images=loaded,
+        pushed_blobs=pusher.pushed_blobs,
+        skipped_blobs=pusher.skipped_blobs,
+        bytes_transferred=pusher.bytes_transferred,
+    )
+
+
+#### Virtual clusters ####
+
+def list_virtual_clusters(config):
+    _require("vcluster", "kubectl")
+    return [_to_virtual_cluster(i) for i in cluster.get_virtual_clusters(config.to_ctx())]
+
+def get_virtual_cluster(config, name):
+    for virtual_cluster in list_virtual_clusters(config):
+        if virtual_cluster.name == name:
+            return virtual_cluster
+    raise VirtualClusterNotFoundError(f"Cluster {name} does not exist")
+
+def wait_virtual_cluster(config, name, status="Running", timeout_seconds=300):
+    return _wait(
+        lambda: (lambda vc: vc if vc.status == status else None)(get_virtual_cluster(config, name)),
+        timeout_seconds,
+        f"Timeout. vcluster {name} is not {status} after {timeout_seconds} seconds",
+    )
+
+def create_virtual_cluster(config, name, switch_context=True, kubeconfig=None, expose_mode="loadbalancer",
+                           from_snapshot=None):
+    """Create a vcluster and merge its context into the kubeconfig.
+
+    expose_mode loadbalancer takes one IP of the MetalLB pool per vcluster. shared routes all the vclusters
+    through one ingress controller by hostname, so the number of vclusters is not limited by the pool.
+    from_snapshot starts the vcluster with the state saved by `snapshot_virtual_cluster`
+    """
+    _require("vcluster", "kubectl")
+    ctx = config.to_ctx()
+    if expose_mode not in cluster.EXPOSE_MODES:
+        raise FieldctlError(f"Unknown expose mode {expose_mode}. Expected one of {cluster.EXPOSE_MODES}")
+    if from_snapshot is not None:
+        snapshots.validate_name(from_snapshot)
+    if from_snapshot and not snapshots.snapshot_exist(config.persisted_folder, from_snapshot):
+        raise SnapshotNotFoundError(f"Snapshot {from_snapshot} does not exist")
+    # Restoring writes into the volume of the vcluster. Never into the one of a running vcluster
+    if from_snapshot and cluster.cluster_exist(ctx, name):
+        raise FieldctlError(f"vcluster {name} already exists. Delete it or choose another name")
+    # One values file per cluster. Clusters can be created concurrently
+    values_file = f"/tmp/vcluster-values-{name}.yaml"
+    logger.info(f"Temporary helm values for vcluster will be stored in { values_file }")
+    # vcluster helm values
+    values_data = {
+        "rbac": {"clusterRole": {"create": True}},
+        "vcluster": {"image": VCLUSTER_IMAGE},
+        "syncer": {"extraArgs": ["--fake-nodes=false", "--sync-all-nodes"]},
+    }
+    expose_flag = " --expose"
+    if expose_mode == "shared":
+        cluster.ensure_shared_ingress(ctx)
+        # The certificate of the API server must be valid for the hostname
+        values_data["syncer"]["extraArgs"].append(f"--tls-san={cluster.shared_hostname(name)}")
+        expose_flag = ""
+
+    # Store helm values
+    with open(values_file, "w") as file:
+        yaml.dump(values_data, file, default_flow_style=False)
+
+    # The vcluster statefulset picks up the volume which already has the data
+    if from_snapshot:
+        snapshots.restore(ctx, name, snapshots.get_snapshot_path(config.persisted_folder, from_snapshot))
+
+    # Create vcluster using helm values
+    status_code, out = sh.run_command(
+        f"vcluster --context {config.main_context} create {name} -n {name}{expose_flag} -f {values_file}"
+    )
+    if status_code != 0:
+        raise CommandError(
+            f"Error creating the new vcluster. if it exists, try:\n\n fieldctl virtual connect -n {name}\n\n",
+            status_code, out
+        )
+    if expose_mode == "shared":
+        cluster.expose_shared(ctx, name)
+
+    completion.add_item(config.persisted_folder, completion.virtual_clusters_key(config.main_context), name)
+
+    # Update the current kubeconfig file with the new context
+    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
+    cluster.connect_to_virtual_cluster(ctx, kubeconfig_path, name, switch_context)
+    if switch_context:
+        cluster.use_context(ctx, name)
+    return dataclasses.replace(get_virtual_cluster(config, name), context=name)
+
+def connect_virtual_cluster(config, name, switch_context=True, kubeconfig=None):
+    # Verify that the virtual cluster exists
+    virtual_cluster = get_virtual_cluster(config, name)
+    ctx = config.to_ctx()
+
+    # Update the current kubeconfig file with context cluster name
+    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
+    cluster.connect_to_virtual_cluster(ctx, kubeconfig_path, name, switch_context)
+    if switch_context:
+        cluster.use_context(ctx, name)
+    return dataclasses.replace(virtual_cluster, context=name)
+
+def snapshot_virtual_cluster(config, name, snapshot):
+    """Save the state of the vcluster (datastore and certificates) in the persisted folder. Returns its path.
+
+    The vcluster is stopped while copying. An existing snapshot with the same name is replaced
+    """
+    snapshots.validate_name(snapshot)
+    get_virtual_cluster(config, name)
+    snapshot_path = snapshots.get_snapshot_path(config.persisted_folder, snapshot)
+    snapshots.save(config.to_ctx(), name, snapshot_path)
+    return snapshot_path
+
+def list_snapshots(config):
+    return snapshots.list_snapshots(config.persisted_folder)
+
+def delete_virtual_cluster(config, name, switch_context=True, kubeconfig=None, timeout_seconds=20):
+    _require("vcluster", "kubectl")
+    ctx = config.to_ctx()
+    # Detele virtual cluster
+    return_code, out = sh.run_command(
+        f"vcluster --context {config.main_context} delete {name} -n {name}"
+    )
+    if return_code != 0:
+        raise CommandError("Error deleting the vcluster", return_code, out)
+
+    completion.remove_item(config.persisted_folder, completion.virtual_clusters_key(config.main_context), name)
+
+    # It is needed to wait until virtual cluster is completely deleted
+    cluster.wait_until_cluster_is_deleted(ctx, timeout_seconds, name)
+    logger.info(f"Delete related namespace {name} in main cluster {config.main_context}")
+    return_code, out = sh.run_command(
+        f"kubectl --context {config.main_context} delete ns {name} --wait=false"
+    )
+    if return_code != 0:
+        raise CommandError("Error deleting namespace. Please, fix manually in the cluster", return_code, out)
+
+    # Remove the context from kubeconfig to keep the file clean
+    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
+    logger.info(f"Remove virtual cluster context from kubeconfig: {kubeconfig_path}")
+    cluster.remove_context_from_kubeconfig(kubeconfig_path, name)
+
+    # Switch context to main cluster
+    if switch_context:
+        cluster.use_context(ctx, config.main_context)
+
+
+#### Shell completion ####
+
+def complete_virtual_cluster_names(config):
+    """Names of the vclusters from the completion index. Refreshed in background when stale"""
+    return completion.get_items(
+        config.persisted_folder,
+        completion.virtual_clusters_key(config.main_context),
+        lambda: [virtual_cluster.name for virtual_cluster in list_virtual_clusters(config)],
+    )
+
+def complete_contexts(config):
+    """Contexts of the current kubeconfig. Refreshed when the kubeconfig changes"""
+    kubeconfig_path = cluster.get_current_kubeconfig_path(config.to_ctx())
+    return completion.get_items(
+        config.persisted_folder,
+        "contexts",
+        lambda: cluster.get_contexts(kubeconfig_path),
+        source=kubeconfig_path,
+    )
+
+
+def warm_caches(config, kubeconfig=None):
+    """Fill the caches of the helpers: binary discovery, parsed kubeconfig and VM inventory.
+
+    `fieldctl serve` calls it before running each request, which starts with them. The caches are only
+    refreshed when the files they come from change
+    """
+    for binary in ["limactl", "vcluster", "kubectl"]:
+        sh.binary_exist(binary)
+    kubeconfig_path = cluster.get_current_kubeconfig_path(config.to_ctx(), kubeconfig)
+    if os.path.isfile(kubeconfig_path):
+        cluster.load_kubeconfig(kubeconfig_path)
+    if sh.binary_exist("limactl"):
+        vmh.get_vms()
+
+
+#### Async variants ####
+
+def _to_async(func):
+    # The underlying binaries block. Each call runs in its own thread
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+    wrapper.__name__ = f"{func.__name__}_async"
+    return wrapper
+
+list_vms_async = _to_async(list_vms)
+get_vm_async = _to_async(get_vm)
+wait_vm_async = _to_async(wait_vm)
+create_vm_async = _to_async(create_vm)
+start_vm_async = _to_async(start_vm)
+stop_vm_async = _to_async(stop_vm)
+connect_vm_async = _to_async(connect_vm)
+delete_vm_async = _to_async(delete_vm)
+load_images_async = _to_async(load_images)
+list_virtual_clusters_async = _to_async(list_virtual_clusters)
+get_virtual_cluster_async = _to_async(get_virtual_cluster)
+wait_virtual_cluster_async = _to_async(wait_virtual_cluster)
+create_virtual_cluster_async = _to_async(create_virtual_cluster)
+connect_virtual_cluster_async = _to_async(connect_virtual_cluster)
+delete_virtual_cluster_async = _to_async(delete_virtual_cluster)
+snapshot_virtual_cluster_async = _to_async(snapshot_virtual_cluster)
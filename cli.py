@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
-import click
 import sys
 import os
+
+import helpers.daemon_helper as daemon
+
+# Forward the command to `fieldctl serve` when it is running. This happens before importing the commands to keep the client thin
+if __name__ == "__main__":
+    exit_code = daemon.forward(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+import click
 import logging
 import log
 
@@ -10,7 +19,7 @@ import log
 from commands.virtual_cluster import virtual_cluster
 from commands.vm import vm
 
-import helpers.vm_helper as vmh
+import api
 
 VERSION_FILE="version.txt"
 
@@ -69,13 +78,7 @@ def cli(ctx, log_level):
     if logger.getEffectiveLevel() < logging.INFO:
         logger.warning(f"LOG_LEVEL: {log_level}")
     # Add context values
-    ctx.obj["MAIN_CONTEXT"] = "field-main"
-    ctx.obj["PERSISTED_FOLDER"] = os.environ.get("HOME") + "/.field"
-    ctx.obj["DEFAULT_KUBECONFIG"] = os.environ.get("HOME") + "/.kube/config"
-    ctx.obj["DEFAULT_PORT_FORWARD"] = 11443
-    base_path = getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__)))
-    ctx.obj["PROVISION_FOLDER"] = vmh.get_path_to_provision(base_path)
-    ctx.obj["LIMA_TEMPLATE"] = vmh.get_path_to_lima_template(base_path)
+    ctx.obj.update(api.Config.from_environment().to_ctx())
     
 @cli.command("version", help="Displays current fieldctl version")
 @click.pass_obj
@@ -85,6 +88,37 @@ def version(ctx):
     return
 
 
+@cli.command("serve", help="Run a local daemon. While it runs, `vm` and `virtual` commands are forwarded to it")
+@click.option(
+    "--socket",
+    "socket_path",
+    default=daemon.get_socket_path,
+    help="UNIX socket to listen on",
+    show_default="$FIELDCTL_SOCKET or `$XDG_RUNTIME_DIR/fieldctl-<uid>/fieldctl.sock`",
+)
+@click.pass_obj
+def serve(ctx, socket_path):
+    """Keeps the CLI warm: modules are imported once. Binaries, the parsed kubeconfig and the VM inventory are cached until their files change.
+    
+    Clients fall back to run the commands directly when the daemon is not running. Set FIELDCTL_NO_DAEMON=1 to force it.
+    
+    Every command runs in its own forked process, reading and writing in the terminal of the client. Ctrl-C in the client stops it
+    """
+    try:
+        daemon.ensure_socket_folder(socket_path)
+    except PermissionError as e:
+        logging.error(e)
+        raise click.Abort()
+    if daemon.is_running(socket_path):
+        logging.error(f"fieldctl serve is already running on {socket_path}")
+        raise click.Abort()
+    try:
+        daemon.serve(cli, socket_path, warm=lambda: api.warm_caches(api.Config.from_environment()))
+    except KeyboardInterrupt:
+        pass
+    logging.info("fieldctl serve stopped")
+
+
 #### Add the command here ####
 # cli.add_command(_examples)
 cli.add_command(vm)
@@ -92,9 +126,14 @@ cli.add_command(virtual_cluster)
 ##############################
 
 # This solves https://github.com/pallets/click/issues/456#issuecomment-159543498
-def main():
+def main(forward=True):
+    if forward:
+        exit_code = daemon.forward(sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
     return cli(obj={})
 
 if __name__ == "__main__":
-    main()
+    # Already tried to forward it at the top of the file
+    main(forward=False)
 
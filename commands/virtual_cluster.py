@@ -1,19 +1,19 @@
 import logging
 
 import click
-import helpers.cluster_helper as cluster
-import helpers.vm_helper as vm
+import api
 import helpers.shell_helper as sh
-import yaml
 
 logger = logging.getLogger('root')
 
-TMP_VALUES_FILE = "/tmp/vcluster-values.yaml"
 CURRENT_CONTEXT="current-context"
 
 def set_context(ctx, param, value):
     """Method to define which is the context to be used: user defined, $KBECONFIG or `~/.kube/config`
     """
+    # Shell completion does not run the main group, so there is no context object to update
+    if ctx.resilient_parsing:
+        return value
     if value == CURRENT_CONTEXT:
         logging.info(f"You are not using the VM as main cluster. Instead, you are using the active CURRENT CONTEXT. This might not be what you want")
         ctx.obj["MAIN_CONTEXT"] = value
@@ -23,10 +23,35 @@ def set_context(ctx, param, value):
         ctx.obj["MAIN_CONTEXT"] = value
     logging.info(f"You are using the VM as main cluster with context: {ctx.obj['MAIN_CONTEXT']}")
 
+def _complete_contexts(ctx, param, incomplete):
+    try:
+        contexts = api.complete_contexts(api.Config.from_environment())
+    except Exception:
+        return []
+    return [i for i in contexts if i.startswith(incomplete)]
+
+def _complete_names(ctx, param, incomplete):
+    # Served from the completion index. Running `vcluster list` on every Tab takes seconds
+    try:
+        config = api.Config.from_environment()
+        if ctx.params.get("main_context"):
+            config.main_context = ctx.params["main_context"]
+        names = api.complete_virtual_cluster_names(config)
+    except Exception:
+        return []
+    return [i for i in names if i.startswith(incomplete)]
+
+def _complete_snapshots(ctx, param, incomplete):
+    try:
+        snapshots = api.list_snapshots(api.Config.from_environment())
+    except Exception:
+        return []
+    return [i for i in snapshots if i.startswith(incomplete)]
+
 # Option re-used by multiple commands
 _common_options = [
     click.option("--main-context", '-ctx', is_flag=False, flag_value=CURRENT_CONTEXT,
-    callback=set_context,
+    callback=set_context, shell_complete=_complete_contexts,
     help="Use TEXT context as main cluster instead of the one in the VM. This is useful when you do not want Lima VM",
     show_default="current context")
 ]
@@ -56,15 +81,13 @@ def virtual_cluster(ctx):
     - Mind the resources (CPUs, disk and memory) for the VM when creating many virtual clusters
     """
     # Verify vcluster is installed
-    returncode, _ = sh.run_command(f"which vcluster")
-    if returncode != 0:
+    if not sh.binary_exist("vcluster"):
         logger.error(
             f"You need to install vcluster (https://www.vcluster.com/docs/getting-started/setup#download-vcluster-cli)"
         )
         raise click.Abort()
     # Verify kubectl is installed
-    returncode, _ = sh.run_command("which kubectl")
-    if returncode != 0:
+    if not sh.binary_exist("kubectl"):
         logger.error(
             f"You need to install kubectl (https://kubernetes.io/docs/tasks/tools/)"
         )
@@ -80,6 +103,7 @@ def list(ctx, main_context):
     
     It shows the vcluster which are installed in the main cluster.
     """
+    # Keep the table of vcluster. `api.list_virtual_clusters` returns them as objects
     sh.run_command(f"vcluster --context {ctx['MAIN_CONTEXT']} list", show_output=True)
     return
 
@@ -95,96 +119,68 @@ def version(ctx, main_context):
 
 @virtual_cluster.command("create", help="Create a vcluster")
 @click.option("--name", "-n", required=True, help="Name for the environment")
+@click.option(
+    "--expose-mode",
+    type=click.Choice(api.EXPOSE_MODES),
+    default="loadbalancer",
+    show_default=True,
+    help="loadbalancer: one IP of the MetalLB pool per vcluster. shared: all vclusters behind one ingress, routed by hostname",
+)
+@click.option("--from", "from_snapshot", help="Start the vcluster from a snapshot. See `fieldctl virtual snapshot`", shell_complete=_complete_snapshots)
 @add_options(_common_options)
 @click.pass_obj
-def create(ctx, name, main_context):
-    logger.info(f"Temporary helm values for vcluster will be stored in { TMP_VALUES_FILE }")
-    # vcluster helm values
-    values_data = {
-        "rbac": {"clusterRole": {"create": True}},
-        "vcluster": {"image": "rancher/k3s:v1.22.5-k3s1"},
-        "syncer": {"extraArgs": ["--fake-nodes=false", "--sync-all-nodes"]},
-    }
-    
-    # Store helm values
-    with open(TMP_VALUES_FILE, "w") as file:
-        yaml.dump(values_data, file, default_flow_style=False)
-        
-    # Create vcluster using helm values
-    status_code, out = sh.run_command(
-        f"vcluster --context {ctx['MAIN_CONTEXT']} create {name} -n {name} --expose -f {TMP_VALUES_FILE}"
-    )
-    if status_code != 0:
-        logger.error(out)
-        logger.error(f"Error creating the new vcluster. if it exists, try:\n\n fieldctl vm connect\n\n")
+def create(ctx, name, expose_mode, from_snapshot, main_context):
+    try:
+        api.create_virtual_cluster(api.Config.from_ctx(ctx), name, expose_mode=expose_mode, from_snapshot=from_snapshot)
+    except api.FieldctlError as e:
+        logger.error(e)
         raise click.Abort()
-    
-    # Update the current kubeconfig file with the new context
-    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx)
-    cluster.connect_to_virtual_cluster(ctx, kubeconfig_path, name)
     logger.info(f"A new context has been created with name `{name}`. You will be switched to that context automatically\n\n")
-    sh.run_command(
-        f"kubectl --context {ctx['MAIN_CONTEXT']} config use-context {name}"
-    )
 
 
 @virtual_cluster.command("connect", help=f"Update current kubeconfig to connect to vcluster")
-@click.option("--name", "-n", required=True, help="Name for the environment")
+@click.option("--name", "-n", required=True, help="Name for the environment", shell_complete=_complete_names)
 @add_options(_common_options)
 @click.pass_obj
 def connect(ctx, name, main_context):
-    # Verify that the virtual cluster exists
-    if not cluster.cluster_exist(ctx, name):
-        logger.error(f"Cluster {name} does not exist")
+    try:
+        api.connect_virtual_cluster(api.Config.from_ctx(ctx), name)
+    except api.FieldctlError as e:
+        logger.error(e)
         raise click.Abort()
-    
-    # Update the current kubeconfig file with context cluster name
-    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx)
-    cluster.connect_to_virtual_cluster(ctx, kubeconfig_path, name)
     logger.info(f"A new context has been created with name `{name}`. You will be switched to that context automatically\n\n")
+
+
+@virtual_cluster.command("snapshot", help="Save the state of a vcluster to create new ones from it")
+@click.option("--name", "-n", required=True, help="Name for the environment", shell_complete=_complete_names)
+@click.option("--as", "snapshot", required=True, help="Name for the snapshot", shell_complete=_complete_snapshots)
+@add_options(_common_options)
+@click.pass_obj
+def snapshot(ctx, name, snapshot, main_context):
+    """Save the datastore of the vcluster, with all its resources (operators, CRDs, etc.), in the persisted folder.
     
-    # Switch context to cluster
-    return_code, _ = sh.run_command(
-        f"kubectl --context {ctx['MAIN_CONTEXT']} config use-context {name}"
-    )
-    if return_code != 0:
-        logger.error(f"Error switching contexts")
+    The vcluster is stopped while copying. Then create new vclusters already in that state:
+    
+    \b
+            fieldctl virtual snapshot -n base --as fixture-x
+            fieldctl virtual create -n foo --from fixture-x
+    """
+    try:
+        snapshot_path = api.snapshot_virtual_cluster(api.Config.from_ctx(ctx), name, snapshot)
+    except api.FieldctlError as e:
+        logger.error(e)
         raise click.Abort()
+    logger.info(f"Snapshot `{snapshot}` saved in {snapshot_path}. Create a vcluster from it with:\n\n  fieldctl virtual create -n <name> --from {snapshot}\n\n")
 
 
 @virtual_cluster.command("delete", help="Delete vcluster")
-@click.option("--name", "-n", required=True, help="Name for the environment")
+@click.option("--name", "-n", required=True, help="Name for the environment", shell_complete=_complete_names)
 @add_options(_common_options)
 @click.pass_obj
 def delete(ctx, name, main_context):
-    # Detele virtual cluster
-    return_code, _ = sh.run_command(
-        f"vcluster --context {ctx['MAIN_CONTEXT']} delete {name} -n {name}"
-    )
-    if return_code != 0:
-        logger.error(f"Error deleting the vcluster")
-        raise click.Abort()
-    
-    # It is needed to wait until virtual cluster is completely deleted
-    cluster.wait_until_cluster_is_deleted(ctx, 20, name)
-    logger.info(f"Delete related namespace {name} in main cluster {ctx['MAIN_CONTEXT']}")
-    return_code, _ = sh.run_command(
-        f"kubectl --context {ctx['MAIN_CONTEXT']} delete ns {name} --wait=false"
-    )
-    if return_code != 0:
-        logger.error(f"Error deleting namespace. Please, fix manually in the cluster")
-        raise click.Abort()
-    
-    # Remove the context from kubeconfig to keep the file clean
-    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx)
-    logger.info(f"Remove virtual cluster context from kubeconfig: {kubeconfig_path}")
-    cluster.remove_context_from_kubeconfig(kubeconfig_path, name)
-    
-    # Switch context to main cluster
-    return_code, _ = sh.run_command(
-        f"kubectl --context {ctx['MAIN_CONTEXT']} config use-context {ctx['MAIN_CONTEXT']}"
-    )
-    if return_code != 0:
-        logger.error(f"Error switching contexts")
+    try:
+        api.delete_virtual_cluster(api.Config.from_ctx(ctx), name)
+    except api.FieldctlError as e:
+        logger.error(e)
         raise click.Abort()
     logger.info(f"Context deleted. You are switched to main cluster context: {ctx['MAIN_CONTEXT']}")
@@ -1,14 +1,31 @@
 import logging
-import shutil
 
 import click
-import helpers.cluster_helper as cluster
+import api
 import helpers.vm_helper as vmh
 import helpers.shell_helper as sh
 
 logger = logging.getLogger('root')
 
 
+def _parse_size(ctx, param, value):
+    if value is None:
+        return 0
+    try:
+        return vmh.parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def _parse_duration(ctx, param, value):
+    if value is None:
+        return 0
+    try:
+        return vmh.parse_duration(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @click.group('vm')
 @click.pass_obj
 def vm(ctx):
@@ -23,8 +40,7 @@ def vm(ctx):
     - Mind the resources (CPUs, disk and memory) for the VM when creating many virtual clusters
     """
     # Verify that limactl is installed in the host
-    returncode, _ = sh.run_command(f"which limactl")
-    if returncode != 0:
+    if not sh.binary_exist("limactl"):
         logger.error(f"You need to install limactl (https://github.com/lima-vm/lima)")
         raise click.Abort()
 
@@ -40,12 +56,10 @@ def version(ctx):
 @vm.command("stop", help="Stop the Lima VM")
 @click.pass_obj
 def stop(ctx):
-    if not vmh.vm_exist(ctx["MAIN_CONTEXT"]):
-        logging.error("VM does not exist. Create it")
-        raise click.Abort()
-    returncode, out = sh.run_command(f"limactl stop {ctx['MAIN_CONTEXT']}", show_output=True)
-    if returncode != 0:
-        logging.error(out)
+    try:
+        api.stop_vm(api.Config.from_ctx(ctx))
+    except api.FieldctlError as e:
+        logging.error(e)
         raise click.Abort()
     logging.info("VM Stopped")
     return
@@ -54,16 +68,10 @@ def stop(ctx):
 @vm.command("start", help="Start teh Lima VM")
 @click.pass_obj
 def start(ctx):
-    # Verify VM exist
-    if not vmh.vm_exist(ctx["MAIN_CONTEXT"]):
-        logging.error("VM does not exist. Create it")
-        raise click.Abort()
-    
-    # Starts VM
-    returncode, out = sh.run_command(f"limactl start --tty=false {ctx['MAIN_CONTEXT']}", show_output=True)
-    if returncode != 0:
-        logging.error("Error creating the VM")
-        logging.error(out)
+    try:
+        api.start_vm(api.Config.from_ctx(ctx))
+    except api.FieldctlError as e:
+        logging.error(e)
         raise click.Abort()
     logging.info("VM started. To merge the kubeconfig run:\n\n  fieldctl vm connect")
 
@@ -94,6 +102,31 @@ def start(ctx):
     help="Kubeconfig file to update",
     show_default="$KUBECONFIG or `~/.kube/config`"
 )
+@click.option(
+    "--io-profile",
+    type=click.Choice(vmh.IO_PROFILES.keys()),
+    default="default",
+    show_default=True,
+    help="Mount type and cache settings for the persisted folder. default: reverse-sshfs, 9p: 9p with mmap cache, virtiofs: requires macOS >= 13",
+)
+@click.option(
+    "--registry-storage",
+    type=click.Choice(vmh.REGISTRY_STORAGES),
+    default="host",
+    show_default=True,
+    help="Where the registry caches store the images. guest uses the VM disk. Persist it with `fieldctl vm cache export`",
+)
+@click.option(
+    "--cache-max-size",
+    callback=_parse_size,
+    help="Prune the registry mirrors down to this size after creating the VM. i.e. 20G",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue a failed creation. Phases which are completed and still valid are skipped",
+)
 @click.option(
     "--yes", "-y",
     help="Run command without asking",
@@ -101,56 +134,24 @@ def start(ctx):
     default=False
 )
 @click.pass_obj
-def create(ctx, cpus, disk, memory, connect, kubeconfig, yes):
-    click.echo(f"the machine will be created with:\ncpus: {cpus}\ndisk: {disk}GiB\nmemory: {memory}GiB")
+def create(ctx, cpus, disk, memory, connect, kubeconfig, io_profile, registry_storage, cache_max_size, resume, yes):
+    click.echo(f"the machine will be created with:\ncpus: {cpus}\ndisk: {disk}GiB\nmemory: {memory}GiB\nio profile: {io_profile}\nregistry storage: {registry_storage}")
     if not yes:
         click.confirm('Use those values?', abort=True)
-    logger.info(f"Persisted data will be created in {ctx['PERSISTED_FOLDER']}")
-    # Copy the provision folder into the fodler which will be persisted into the VM. This is `~/.field`
-    vmh.copy_persisted_folder(ctx['PROVISION_FOLDER'], ctx["PERSISTED_FOLDER"])
-    filename = f"/tmp/{ctx['MAIN_CONTEXT']}.yaml"
-    
-    # Copy the template to a temporary location and update its values to include port, resources and persisted folder
-    shutil.copy(ctx["LIMA_TEMPLATE"], filename)
-    vmh.update_allocated_resources(ctx, filename, cpus, disk, memory)
-    vmh.add_home_persisted_folder(ctx, filename)
-    vmh.add_forwarded_port(ctx, filename)
-    
-    # Validate the configuration works
-    returncode, out = sh.run_command(f"limactl validate {filename} --debug")
-    if returncode != 0:
-        logging.error("Error validating the VM")
-        logging.error(out)
-        raise click.Abort()
-    
-    # Create VM
-    logger.info(f"Create the Lima VM with name: {ctx['MAIN_CONTEXT']}")
-    returncode, _ = sh.run_command(f"limactl start --tty=false {filename}", show_output=True)
-    if returncode != 0:
-        logging.error("Error creating the machine. Try again:\n\n\tfieldctl vm rm\t\t\t-- Remove the created files\n\tfieldctl vm create\t\t-- Create again")
-        raise click.Abort()
-    
-    logger.info(
-        f"Install cache registries. This happens here since it cannot be done in provision scripts"
-    )
-    # Install docker registry caches (grc, quay, k8s, docker). The context of this fodler is persisted in `~\fieldctl`
-    returncode, out = sh.run_command(
-        f"limactl shell --workdir='/' {ctx['MAIN_CONTEXT']} sh -c 'cd $FIELDCTL_HOME; ./deploy-caches.sh'"
-    )
-    if returncode != 0:
-        logging.error("Error creating registries")
-        logging.error(out)
+    try:
+        api.create_vm(
+            api.Config.from_ctx(ctx), cpus, disk, memory,
+            io_profile=io_profile,
+            registry_storage=registry_storage,
+            cache_max_size=cache_max_size,
+            connect=connect,
+            kubeconfig=kubeconfig,
+            resume=resume,
+        )
+    except api.FieldctlError as e:
+        logging.error(e)
+        logging.error("Fix the issue and continue from the last completed phase with the same values:\n\n\tfieldctl vm create --resume\n\nOr start from scratch:\n\n\tfieldctl vm rm\t\t\t-- Remove the created files\n\tfieldctl vm create\t\t-- Create again")
         raise click.Abort()
-    
-    # Connect to the k3s (main cluster) provisioned in the VM. 
-    # The kubeconfig file will be updated with te new details for the main cluster context
-    if connect:
-        logging.info("Download kubeconfig from VM and mergng into the current one")
-        kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
-        returncode, out = cluster.connect_to_main_cluster(ctx, kubeconfig_path)
-        if returncode != 0:
-            logging.error(out)
-            raise click.Abort()
     logging.info("VM created. Now run:\n\n  fieldctl vm connect\t\t\t\tto connect to the main cluster\n\n  fieldctl virtual create -n <name>\t\tto create a virtual cluster")
     return
 
@@ -165,19 +166,11 @@ def create(ctx, cpus, disk, memory, connect, kubeconfig, yes):
 )
 @click.pass_obj
 def remove(ctx, kubeconfig):
-    # Verify VM exist
-    if not vmh.vm_exist(ctx["MAIN_CONTEXT"]):
-        logging.error("VM does not exist. Create it")
+    try:
+        api.delete_vm(api.Config.from_ctx(ctx), kubeconfig)
+    except api.FieldctlError as e:
+        logging.error(e)
         raise click.Abort()
-    
-    # Remove VM
-    returncode, out = sh.run_command(f"limactl rm {ctx['MAIN_CONTEXT']} -f")
-    if returncode != 0:
-        logging.error("Error deleting registries")
-        logging.error(out)
-        raise click.Abort()
-    kubeconfig = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
-    cluster.remove_context_from_kubeconfig(kubeconfig, {ctx['MAIN_CONTEXT']})
     logging.info("VM deleted")
     return
 
@@ -198,6 +191,114 @@ def show_ssh(ctx):
     logging.info(out)
     return
 
+@vm.group("cache")
+@click.pass_obj
+def cache(ctx):
+    """Operate the registry caches deployed in the Lima VM
+    
+    TIPS:
+    
+    - When the VM was created with `--registry-storage guest`, the images are only in the VM disk. Run `fieldctl vm cache export` before `fieldctl vm rm` to keep them
+    
+    - The registry mirrors grow unbounded. Run `fieldctl vm cache prune --max-size 20G` from time to time
+    """
+    if not vmh.vm_exist(ctx["MAIN_CONTEXT"]):
+        logging.error("VM does not exist. Create it")
+        raise click.Abort()
+
+
+@cache.command("export", help="Copy the registry data from the VM disk into the persisted folder")
+@click.pass_obj
+def cache_export(ctx):
+    _sync_caches(ctx, "export")
+
+
+@cache.command("import", help="Copy the registry data from the persisted folder into the VM disk")
+@click.pass_obj
+def cache_import(ctx):
+    _sync_caches(ctx, "import")
+
+
+def _sync_caches(ctx, direction):
+    # Registries are stopped while copying. The script does nothing if the registry storage is the persisted folder
+    returncode, out = vmh.run_persisted_script(ctx['MAIN_CONTEXT'], f"sync-caches.sh {direction}")
+    if returncode != 0:
+        logging.error(f"Error running cache {direction}")
+        logging.error(out)
+        raise click.Abort()
+    logging.info(f"Cache {direction} completed")
+
+
+@cache.command("stats", help="Show size, blob count and last access time per registry")
+@click.pass_obj
+def cache_stats(ctx):
+    returncode, stats = vmh.get_cache_stats(ctx['MAIN_CONTEXT'])
+    if returncode != 0:
+        logging.error("Error reading registry stats")
+        logging.error(stats)
+        raise click.Abort()
+    click.echo(f"{'REGISTRY':<16}{'SIZE':>12}{'BLOBS':>8}  LAST ACCESS")
+    for stat in stats:
+        last_access = stat["last_access"].strftime("%Y-%m-%d %H:%M") if stat["last_access"] else "-"
+        click.echo(f"{stat['name']:<16}{vmh.format_size(stat['size']):>12}{stat['blobs']:>8}  {last_access}")
+
+
+@cache.command("prune", help="Evict least recently used blobs from the registry mirrors and garbage collect")
+@click.option("--max-size", callback=_parse_size, help="Evict blobs until the mirrors take up to this size. i.e. 20G")
+@click.option("--older-than", callback=_parse_duration, help="Evict blobs not accessed within this period. i.e. 30d")
+@click.pass_obj
+def cache_prune(ctx, max_size, older_than):
+    # Only the mirrors are pruned. The local registry has no upstream to pull the blobs again
+    if not max_size and not older_than:
+        logging.error("Give --max-size and/or --older-than")
+        raise click.Abort()
+    returncode, out = vmh.prune_caches(ctx['MAIN_CONTEXT'], max_size, older_than)
+    if returncode != 0:
+        logging.error("Error pruning registries")
+        logging.error(out)
+        raise click.Abort()
+    logging.info(out.strip() if out else "Registries pruned")
+
+
+@cache.command("gc", help="Run the registry garbage collection. Registries are stopped meanwhile")
+@click.pass_obj
+def cache_gc(ctx):
+    returncode, out = vmh.run_persisted_script(ctx['MAIN_CONTEXT'], "manage-caches.sh gc")
+    if returncode != 0:
+        logging.error("Error running garbage collection")
+        logging.error(out)
+        raise click.Abort()
+    logging.info("Garbage collection completed")
+
+
+@vm.command("load-images", help="Push images into the local registry of the VM")
+@click.argument("images", nargs=-1)
+@click.option("--from-dir", type=click.Path(exists=True, file_okay=False), help="Folder with image archives (*.tar) created with `docker save`")
+@click.option("--engine", type=click.Choice(["docker", "nerdctl", "podman"]), default="docker", show_default=True, help="Where to take IMAGES from")
+@click.option("--parallel", type=click.IntRange(min=1), default=4, show_default=True, help="Images pushed at the same time")
+@click.pass_obj
+def load_images(ctx, images, from_dir, engine, parallel):
+    """Push many images in parallel into the local registry (`k3s-local-registry`). Layers which are already in the
+    registry are not sent again.
+    
+    The clusters pull them from `local.registry.io/<image>`
+    
+    \b
+            fieldctl vm load-images my-app:dev my-worker:dev
+            fieldctl vm load-images --from-dir ./images
+    """
+    try:
+        result = api.load_images(api.Config.from_ctx(ctx), images, from_dir, engine, parallel)
+    except api.FieldctlError as e:
+        logging.error(e)
+        raise click.Abort()
+    for image in result.images:
+        click.echo(image)
+    logging.info(
+        f"Transferred {vmh.format_size(result.bytes_transferred)}. Blobs pushed: {result.pushed_blobs}, already in the registry: {result.skipped_blobs}"
+    )
+
+
 @vm.command("connect", help="Get k3s kubeconfig file to connect to the cluster")
 @click.option(
     "--kubeconfig",
@@ -207,9 +308,9 @@ def show_ssh(ctx):
 @click.pass_obj
 def connect(ctx, kubeconfig):
     # Connect to the k3s (main cluster) deployed in the VM
-    kubeconfig_path = cluster.get_current_kubeconfig_path(ctx, kubeconfig)
-    if not vmh.vm_exist(ctx["MAIN_CONTEXT"]):
-        logging.error("VM does not exist. Create it")
+    try:
+        api.connect_vm(api.Config.from_ctx(ctx), kubeconfig)
+    except api.FieldctlError as e:
+        logging.error(e)
         raise click.Abort()
-    cluster.connect_to_main_cluster(ctx, kubeconfig_path)
     logging.info("Connect to main cluster. Run:\n\n kubectl config get-contexts\t\t-- to see the new context")
\ No newline at end of file
@@ -0,0 +1,38 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('root')
+
+
+def load(path):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except ValueError:
+        logger.warning(f"Ignoring corrupted checkpoint {path}")
+        return None
+
+def new(params):
+    return {"params": params, "phases": {}}
+
+def is_completed(checkpoint, phase):
+    return phase in checkpoint["phases"]
+
+def get_phase(checkpoint, phase):
+    return checkpoint["phases"].get(phase, {})
+
+def complete(path, checkpoint, phase, **data):
+    # Saved after every phase so that a failure in the next one keeps the progress
+    checkpoint["phases"][phase] = {"completed": time.time(), **data}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(tmp_path, path)
+
+def clear(path):
+    if os.path.isfile(path):
+        os.unlink(path)
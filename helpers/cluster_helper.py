@@ -1,23 +1,44 @@
+import copy
 import datetime
 import json
 import logging
 import os
 import shutil
+import threading
 import time
 
-import click
 import yaml
 import helpers.shell_helper as sh
+from helpers.exceptions import CommandError, FieldctlError, WaitTimeoutError
 
 logger = logging.getLogger('root')
 
+EXPOSE_MODES = ["loadbalancer", "shared"]
+# Shared mode: all vcluster API servers are behind one ingress controller. It routes by SNI hostname
+SHARED_DOMAIN = "vcluster.field"
+INGRESS_MANIFEST = "https://raw.githubusercontent.com/kubernetes/ingress-nginx/controller-v1.1.0/deploy/static/provider/cloud/deploy.yaml"
+INGRESS_NAMESPACE = "ingress-nginx"
+INGRESS_CONTROLLER = "ingress-nginx-controller"
+
+_ingress_lock = threading.Lock()
+
+# The kubeconfig file is read, updated and written back. Serialize it when clusters are operated concurrently (i.e. the async API)
+_kubeconfig_lock = threading.RLock()
+# Parsed kubeconfig files by path: (mtime and size, content). Reused while the file does not change (i.e. `fieldctl serve`)
+_kubeconfigs = {}
+
+def get_virtual_clusters(ctx):
+    returncode, out = sh.run_command(
+        f"vcluster --context {ctx['MAIN_CONTEXT']} list --output json"
+    )
+    if returncode != 0:
+        raise CommandError("Error listing the vclusters", returncode, out)
+    return json.loads(out)
+
 def cluster_exist(ctx, name):
     # Verify that the cluster exist
     logger.info(f"Check if cluster exist")
-    _, out = sh.run_command(
-        f"vcluster --context {ctx['MAIN_CONTEXT']} list --output json"
-    )
-    vclusters = json.loads(out)
+    vclusters = get_virtual_clusters(ctx)
     # If the virtual cluster is found, the length is greater than 0
     return len([i for i in vclusters if i["Name"] == name])
 
@@ -29,10 +50,9 @@ def wait_until_cluster_is_deleted(ctx, timeout_seconds, name):
     # Iterate until either cluster does not exist or timeout
     while True:
         if datetime.datetime.now() > in_waiting_seconds:
-            logger.error(
+            raise WaitTimeoutError(
                 f"Timeout. vcluster is not deleted. Please, fix manually with deleting the namespace {name} directly in the cluster"
             )
-            raise click.Abort()
         if not cluster_exist(ctx, name):
             return
         time.sleep(1)
@@ -45,8 +65,34 @@ def get_current_kubeconfig_path(ctx, kubeconfig=None):
         return os.environ["KUBECONFIG"]
     return ctx["DEFAULT_KUBECONFIG"]
 
-def _merge_kubeconfig_to(kubeconfig, path):
+def load_kubeconfig(path):
+    """Parsed kubeconfig. It returns a copy, so the callers can update it"""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _kubeconfigs.get(path)
+    if cached is None or cached[0] != version:
+        with open(path, "r") as file:
+            try:
+                cached = (version, yaml.safe_load(file) or {})
+            except yaml.YAMLError as exc:
+                raise FieldctlError(f"{exc}")
+        _kubeconfigs[path] = cached
+    return copy.deepcopy(cached[1])
+
+def get_contexts(path):
+    if not os.path.isfile(path):
+        return []
+    kubeconfig = load_kubeconfig(path)
+    return [context["name"] for context in kubeconfig.get("contexts") or []]
+
+def _merge_kubeconfig_to(kubeconfig, path, switch_context=True):
+    with _kubeconfig_lock:
+        _merge_kubeconfig_to_unlocked(kubeconfig, path, switch_context)
+
+def _merge_kubeconfig_to_unlocked(kubeconfig, path, switch_context=True):
     logger.info(f"Merge new context to {path}")
+    if not switch_context:
+        kubeconfig.pop("current-context", None)
     
     # If the kubeconfig does not exist, create the new one directly and exit
     if not os.path.isfile(path):
@@ -56,8 +102,7 @@ def _merge_kubeconfig_to(kubeconfig, path):
         return
         
     # If the kubeconfig already exist, merge with the new one
-    with open(path, "r") as file:
-        current_kubeconfig = yaml.load(file, Loader=yaml.FullLoader)
+    current_kubeconfig = load_kubeconfig(path)
 
     new_context_name = kubeconfig["clusters"][0]["cluster"]["name"]
     new_cluster = kubeconfig["clusters"][0]
@@ -72,7 +117,8 @@ def _merge_kubeconfig_to(kubeconfig, path):
     current_kubeconfig = _merge_config_user(
         current_kubeconfig, new_context_name, new_user
     )
-    current_kubeconfig["current-context"] = new_context_name
+    if switch_context:
+        current_kubeconfig["current-context"] = new_context_name
     
     # Backup the old kubeconfig before saving
     _backup_current_kubeconfig(path)
@@ -107,26 +153,117 @@ def _merge_config_cluster(current_kubeconfig, new_context_name, new_cluster):
     current_kubeconfig["clusters"].append(new_cluster)
     return current_kubeconfig
 
-def connect_to_virtual_cluster(ctx, kubeconfig_path, name):
+def shared_hostname(name):
+    return f"{name}.{SHARED_DOMAIN}"
+
+def ensure_shared_ingress(ctx, timeout_seconds=180):
+    """Install the ingress controller for the shared mode once. It takes one LoadBalancer IP for all the vclusters"""
+    main_context = ctx['MAIN_CONTEXT']
+    with _ingress_lock:
+        return_code, out = sh.run_command(
+            f"kubectl --context {main_context} -n {INGRESS_NAMESPACE} get deployment {INGRESS_CONTROLLER} -o jsonpath={{.spec.template.spec.containers[0].args}}"
+        )
+        if return_code == 0 and "--enable-ssl-passthrough" in out:
+            return
+        logger.info(f"Install ingress controller for the shared exposure mode in main cluster {main_context}")
+        return_code, out = sh.run_command(f"kubectl --context {main_context} apply -f {INGRESS_MANIFEST}")
+        if return_code != 0:
+            raise CommandError("Error installing the ingress controller", return_code, out)
+        # The API servers terminate TLS themselves. The controller only routes by SNI
+        return_code, out = sh.run_command(
+            f"kubectl --context {main_context} -n {INGRESS_NAMESPACE} patch deployment {INGRESS_CONTROLLER} --type=json "
+            '-p \'[{"op": "add", "path": "/spec/template/spec/containers/0/args/-", "value": "--enable-ssl-passthrough"}]\''
+        )
+        if return_code != 0:
+            raise CommandError("Error enabling ssl passthrough in the ingress controller", return_code, out)
+        return_code, out = sh.run_command(
+            f"kubectl --context {main_context} -n {INGRESS_NAMESPACE} rollout status deployment {INGRESS_CONTROLLER} --timeout={timeout_seconds}s"
+        )
+        if return_code != 0:
+            raise CommandError("The ingress controller is not ready", return_code, out)
+
+def get_shared_ingress_ip(ctx, timeout_seconds=60):
+    in_waiting_seconds = datetime.datetime.now() + datetime.timedelta(0, timeout_seconds)
+    # MetalLB might take a few seconds to assign the IP
+    while True:
+        _, out = sh.run_command(
+            f"kubectl --context {ctx['MAIN_CONTEXT']} -n {INGRESS_NAMESPACE} get service {INGRESS_CONTROLLER} -o jsonpath={{.status.loadBalancer.ingress[0].ip}}"
+        )
+        if out.strip():
+            return out.strip()
+        if datetime.datetime.now() > in_waiting_seconds:
+            raise WaitTimeoutError(f"Timeout. The ingress controller has no LoadBalancer IP after {timeout_seconds} seconds")
+        time.sleep(1)
+
+def expose_shared(ctx, name):
+    # Route the hostname of the vcluster to its API server
+    ingress = {
+        "apiVersion": "networking.k8s.io/v1",
+        "kind": "Ingress",
+        "metadata": {
+            "name": f"{name}-api",
+            "namespace": name,
+            "annotations": {
+                "nginx.ingress.kubernetes.io/backend-protocol": "HTTPS",
+                "nginx.ingress.kubernetes.io/ssl-passthrough": "true",
+            },
+        },
+        "spec": {
+            "ingressClassName": "nginx",
+            "rules": [{
+                "host": shared_hostname(name),
+                "http": {"paths": [{
+                    "path": "/",
+                    "pathType": "ImplementationSpecific",
+                    "backend": {"service": {"name": name, "port": {"number": 443}}},
+                }]},
+            }],
+        },
+    }
+    ingress_file = f"/tmp/vcluster-ingress-{name}.yaml"
+    with open(ingress_file, "w") as file:
+        yaml.dump(ingress, file, default_flow_style=False)
+    return_code, out = sh.run_command(f"kubectl --context {ctx['MAIN_CONTEXT']} apply -f {ingress_file}")
+    if return_code != 0:
+        raise CommandError("Error creating the ingress for the vcluster", return_code, out)
+
+def get_shared_hostname(ctx, name):
+    # Returns None when the vcluster is exposed with its own LoadBalancer
+    return_code, out = sh.run_command(
+        f"kubectl --context {ctx['MAIN_CONTEXT']} -n {name} get ingress {name}-api -o jsonpath={{.spec.rules[0].host}}"
+    )
+    if return_code != 0 or not out.strip():
+        return None
+    return out.strip()
+
+def connect_to_virtual_cluster(ctx, kubeconfig_path, name, switch_context=True):
     logger.debug("Retrieve vcluster kubeconfig")
+    server_flag = ""
+    hostname = get_shared_hostname(ctx, name)
+    if hostname:
+        server = f"https://{get_shared_ingress_ip(ctx)}"
+        server_flag = f" --server={server}"
     return_code, out = sh.run_command(
-        f"vcluster --context {ctx['MAIN_CONTEXT']} connect {name} -n {name} --print --silent"
+        f"vcluster --context {ctx['MAIN_CONTEXT']} connect {name} -n {name} --print --silent{server_flag}"
     )
     if return_code != 0:
-        logger.error(
-            f"Error retreiving the kubeconfig. Check in the cluster the status of the vcluster pod. Or try:\n\n  fieldctl virtual connect --name {name}"
+        raise CommandError(
+            f"Error retreiving the kubeconfig. Check in the cluster the status of the vcluster pod. Or try:\n\n  fieldctl virtual connect --name {name}",
+            return_code, out
         )
-        raise click.Abort()
     vcluster_cluster_config = yaml.load(out, Loader=yaml.FullLoader, )
     vcluster_cluster_config = _update_context_name(vcluster_cluster_config, name)
-    _merge_kubeconfig_to(vcluster_cluster_config, kubeconfig_path)
+    if hostname:
+        # All the vclusters share the IP. The TLS server name selects the vcluster without DNS
+        vcluster_cluster_config = _update_context_server(vcluster_cluster_config, server)
+        vcluster_cluster_config["clusters"][0]["cluster"]["tls-server-name"] = hostname
+    _merge_kubeconfig_to(vcluster_cluster_config, kubeconfig_path, switch_context)
 
 def connect_to_main_cluster(ctx, kubeconfig_path):
     returncode, out = sh.run_command(
         f"limactl shell --workdir='/' {ctx['MAIN_CONTEXT']} sudo cat /etc/rancher/k3s/k3s.yaml")
     if returncode != 0:
-        logger.error(out)
-        raise click.Abort()
+        raise CommandError("Error retrieving the kubeconfig from the VM", returncode, out)
     main_cluster_config = yaml.load(out, Loader=yaml.FullLoader)
     main_cluster_config = _update_context_name(main_cluster_config, ctx["MAIN_CONTEXT"])
     
@@ -152,13 +289,21 @@ def _update_context_name(kubeconfig, name):
     kubeconfig["current-context"] = name
     return kubeconfig
 
+def use_context(ctx, name):
+    # kubectl writes the kubeconfig too
+    with _kubeconfig_lock:
+        return_code, out = sh.run_command(
+            f"kubectl --context {ctx['MAIN_CONTEXT']} config use-context {name}"
+        )
+    if return_code != 0:
+        raise CommandError("Error switching contexts", return_code, out)
+
 def remove_context_from_kubeconfig(path, name):
-    with open(path, "r") as file:
-        try:
-            kubeconfig = yaml.safe_load(file)
-        except yaml.YAMLError as exc:
-            logger.error(f"{exc}")
-            raise click.Abort()
+    with _kubeconfig_lock:
+        _remove_context_from_kubeconfig_unlocked(path, name)
+
+def _remove_context_from_kubeconfig_unlocked(path, name):
+    kubeconfig = load_kubeconfig(path)
     for i, user in enumerate(kubeconfig["users"]):
         if user["name"] == name:
             kubeconfig["users"].pop(i)
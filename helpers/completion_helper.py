@@ -0,0 +1,141 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger('root')
+
+# Index of names for the shell completion. It is stored in the persisted folder
+INDEX_FILE = "completion-index.json"
+# Entries older than this are returned but refreshed in background
+TTL_SECONDS = 10
+# A refresh which did not finish in this time is considered dead
+REFRESH_TIMEOUT_SECONDS = 60
+
+
+def virtual_clusters_key(main_context):
+    return f"virtual/{main_context}"
+
+def _index_path(persisted_folder):
+    return os.path.join(persisted_folder, INDEX_FILE)
+
+def _load(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+@contextlib.contextmanager
+def _locked(path):
+    # Serialize the updates of the index between threads (i.e. the async API) and processes (i.e. the background refresh)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _write(path, index):
+    # Write and rename so that a completion never reads a half written index
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(index, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _set_entry(index, key, items, source_mtime=None):
+    index[key] = {"updated": time.time(), "items": items, "source_mtime": source_mtime}
+
+def _save_entry(path, key, items, source_mtime=None):
+    with _locked(path):
+        index = _load(path)
+        _set_entry(index, key, items, source_mtime)
+        _write(path, index)
+
+def _update_entry(path, key, update):
+    # Best effort. The index is only a cache for the shell completion
+    try:
+        with _locked(path):
+            index = _load(path)
+            entry = index.get(key)
+            if entry is None:
+                return
+            items = update(entry["items"])
+            if items != entry["items"]:
+                _set_entry(index, key, items)
+                _write(path, index)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Error updating the completion index {path}: {e}")
+
+def _acquire_refresh_lock(path, key):
+    lock_path = f"{path}.{key.replace('/', '_')}.lock"
+    try:
+        if time.time() - os.path.getmtime(lock_path) > REFRESH_TIMEOUT_SECONDS:
+            os.unlink(lock_path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return lock_path
+    except OSError:
+        return None
+
+def _refresh_in_background(path, key, refresh):
+    # Only one refresh per key at a time
+    lock_path = _acquire_refresh_lock(path, key)
+    if lock_path is None:
+        return
+    pid = os.fork()
+    if pid:
+        # The intermediate child exits right away. The refresh is not a child of this process (i.e. `fieldctl serve`)
+        os.waitpid(pid, 0)
+        return
+    try:
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        # The shell waits until every copy of its stdout is closed. Detach from it. Under `fieldctl serve` the
+        # terminal of the client is also open in other fds
+        os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in [0, 1, 2]:
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        _save_entry(path, key, refresh())
+    except Exception:
+        pass
+    finally:
+        try:
+            os.unlink(lock_path)
+        except OSError:
+            pass
+        os._exit(0)
+
+def get_items(persisted_folder, key, refresh, source=None):
+    """Return the cached items of the key.
+
+    refresh is called when there is no entry yet or when the file `source` changed since the last refresh.
+    Stale entries are returned as they are and refreshed in background
+    """
+    path = _index_path(persisted_folder)
+    entry = _load(path).get(key)
+    source_mtime = os.path.getmtime(source) if source and os.path.exists(source) else None
+    if entry is None or entry.get("source_mtime") != source_mtime:
+        items = refresh()
+        _save_entry(path, key, items, source_mtime)
+        return items
+    if source is None and time.time() - entry["updated"] > TTL_SECONDS:
+        _refresh_in_background(path, key, refresh)
+    return entry["items"]
+
+def add_item(persisted_folder, key, item):
+    # Keep the index up to date with the changes done by this CLI
+    _update_entry(_index_path(persisted_folder), key, lambda items: items if item in items else items + [item])
+
+def remove_item(persisted_folder, key, item):
+    _update_entry(_index_path(persisted_folder), key, lambda items: [i for i in items if i != item])
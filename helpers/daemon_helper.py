@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import signal
+import socket
+import stat
+import sys
+import threading
+import traceback
+
+# Only standard library imports. This module is loaded before anything else to keep the client thin
+
+logger = logging.getLogger('root')
+
+SOCKET_VAR_NAME = "FIELDCTL_SOCKET"
+NO_DAEMON_VAR_NAME = "FIELDCTL_NO_DAEMON"
+COMPLETE_VAR_NAME = "_FIELDCTL_COMPLETE"
+FORWARDED_COMMANDS = ["vm", "virtual"]
+STDIO_FDS = [0, 1, 2]
+BUFFER_SIZE = 65536
+# Finished requests are reaped at least this often
+ACCEPT_TIMEOUT_SECONDS = 1
+
+
+def get_socket_path():
+    # Default to a socket in a per-user folder. `$FIELDCTL_SOCKET` overrides it
+    if os.environ.get(SOCKET_VAR_NAME):
+        return os.environ[SOCKET_VAR_NAME]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    return os.path.join(runtime_dir, f"fieldctl-{os.getuid()}", "fieldctl.sock")
+
+def _is_private_folder(folder):
+    # Nobody else can create or replace the socket. i.e. `/tmp` is shared by all the users
+    try:
+        folder_stat = os.lstat(folder)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(folder_stat.st_mode)
+        and folder_stat.st_uid == os.getuid()
+        and not folder_stat.st_mode & 0o077
+    )
+
+def _is_trusted(socket_path):
+    # The client sends its environment (i.e. credentials) and its terminal. Only to a daemon of the same user
+    try:
+        socket_stat = os.lstat(socket_path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISSOCK(socket_stat.st_mode)
+        and socket_stat.st_uid == os.getuid()
+        and _is_private_folder(os.path.dirname(os.path.abspath(socket_path)))
+    )
+
+def ensure_socket_folder(socket_path):
+    """Create the folder of the socket only accessible by the user. Raises PermissionError if it is not private"""
+    folder = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    if not _is_private_folder(folder):
+        raise PermissionError(
+            f"The folder of the socket {folder} must be owned by you and only accessible by you (chmod 700)"
+        )
+
+def is_running(socket_path):
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+def _is_forwarded(args):
+    # Shell completion has no arguments. The words are in the environment
+    if COMPLETE_VAR_NAME in os.environ:
+        return True
+    # Skip the options of the main group. i.e. `-l debug`
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        i += 1 if "=" in args[i] else 2
+    return i < len(args) and args[i] in FORWARDED_COMMANDS
+
+def _encode(message):
+    return json.dumps(message).encode() + b"\n"
+
+def _receive(conn, with_fds=False):
+    fds = []
+    if with_fds:
+        data, fds, _, _ = socket.recv_fds(conn, BUFFER_SIZE, len(STDIO_FDS))
+    else:
+        data = conn.recv(BUFFER_SIZE)
+    while data and not data.endswith(b"\n"):
+        chunk = conn.recv(BUFFER_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return (json.loads(data) if data else None), fds
+
+def forward(args):
+    """Run the command in `fieldctl serve` if it is running.
+
+    Returns the exit code of the command or None when it must run directly
+    """
+    if os.environ.get(NO_DAEMON_VAR_NAME) or not _is_forwarded(args):
+        return None
+    socket_path = get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    if not _is_trusted(socket_path):
+        sys.stderr.write(
+            f"Ignoring {socket_path}: the socket and its folder must be owned by you and private. Running the command directly\n"
+        )
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        # Stale socket. The daemon is not running
+        client.close()
+        return None
+    request = {
+        "args": args,
+        "prog_name": os.path.basename(sys.argv[0]),
+        "env": dict(os.environ),
+        "cwd": os.getcwd(),
+    }
+    # The daemon writes and reads directly in the terminal of the client
+    with client:
+        socket.send_fds(client, [_encode(request)], STDIO_FDS)
+        try:
+            response, _ = _receive(client)
+        except KeyboardInterrupt:
+            response = _cancel(client)
+    if response is None:
+        sys.stderr.write(f"fieldctl serve closed the connection. Set {NO_DAEMON_VAR_NAME}=1 to run without it\n")
+        return 1
+    return response["exit_code"]
+
+def _cancel(client):
+    # Ctrl-C only reaches the client. Stop the command in the daemon too, otherwise it keeps using the terminal
+    try:
+        client.sendall(_encode({"cancel": True}))
+        response, _ = _receive(client)
+    except (KeyboardInterrupt, OSError):
+        # Closing the connection cancels it as well
+        response = None
+    return response or {"exit_code": 130}
+
+def _set_environment(request):
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.chdir(request["cwd"])
+
+def _warm(warm, request):
+    # Fill the caches in the environment of the client. Its requests inherit them
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    try:
+        _set_environment(request)
+        warm()
+    except Exception as e:
+        logger.debug(f"Error warming the caches: {e}")
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        os.chdir(saved_cwd)
+
+def _watch(conn, done):
+    # A cancel message or the client going away interrupts the command and the binaries it runs
+    try:
+        _receive(conn)
+    except (OSError, ValueError):
+        pass
+    if not done.is_set():
+        logger.debug("Request cancelled by the client")
+        os.killpg(os.getpgrp(), signal.SIGINT)
+
+def _run(cli, request, fds, conn):
+    # Run in a forked process, in its own process group so that it can be interrupted alone
+    os.setpgid(0, 0)
+    # The daemon might ignore SIGINT (i.e. `fieldctl serve &`). The command and its binaries must not
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for fd, client_fd in zip(STDIO_FDS, fds):
+        os.dup2(client_fd, fd)
+        os.close(client_fd)
+    _set_environment(request)
+    done = threading.Event()
+    threading.Thread(target=_watch, args=(conn, done), daemon=True).start()
+    try:
+        cli.main(args=request["args"], prog_name=request["prog_name"], obj={})
+        exit_code = 0
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        else:
+            exit_code = e.code if isinstance(e.code, int) else 1
+    except KeyboardInterrupt:
+        exit_code = 130
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    done.set()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return exit_code
+
+def _reap(children):
+    for pid in list(children):
+        try:
+            finished, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            finished = pid
+        if finished:
+            children.discard(pid)
+
+def _handle(cli, server, conn, warm, children):
+    request, fds = _receive(conn, with_fds=True)
+    # A connection without request is `is_running` checking the socket
+    if request is None or len(fds) != len(STDIO_FDS):
+        if request is not None:
+            logger.warning("Ignoring malformed request")
+        for client_fd in fds:
+            os.close(client_fd)
+        return
+    logger.debug(f"Request: {' '.join(request['args'])}")
+    if warm is not None:
+        _warm(warm, request)
+    pid = os.fork()
+    if pid:
+        children.add(pid)
+        for client_fd in fds:
+            os.close(client_fd)
+        return
+    exit_code = 1
+    try:
+        server.close()
+        exit_code = _run(cli, request, fds, conn)
+        conn.sendall(_encode({"exit_code": exit_code}))
+    except OSError:
+        logger.warning("Client disconnected before the command finished")
+    finally:
+        # Never return into the accept loop of the daemon
+        os._exit(exit_code)
+
+def serve(cli, socket_path, warm=None):
+    """Serve the commands forwarded by the clients.
+
+    Every request runs in a forked process, so a long command (i.e. `vm create`) or a prompt does not block
+    the others. The modules are imported once. warm is called before forking each request to fill the
+    caches of the helpers, which the request inherits
+    """
+    ensure_socket_folder(socket_path)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen()
+    # Remove the socket on `kill` as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.settimeout(ACCEPT_TIMEOUT_SECONDS)
+    logger.info(f"Listening on {socket_path}")
+    children = set()
+    try:
+        while True:
+            _reap(children)
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.settimeout(None)
+                _handle(cli, server, conn, warm, children)
+    finally:
+        server.close()
+        os.unlink(socket_path)
@@ -0,0 +1,36 @@
+class FieldctlError(Exception):
+    """Base error for the failures of the API. The click commands log it and abort"""
+
+
+class CommandError(FieldctlError):
+    """An underlying binary (limactl, vcluster, kubectl) failed"""
+
+    def __init__(self, message, returncode=None, output=None):
+        super().__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        if self.output:
+            return f"{super().__str__()}\n{self.output}"
+        return super().__str__()
+
+
+class BinaryNotFoundError(FieldctlError):
+    pass
+
+
+class VMNotFoundError(FieldctlError):
+    pass
+
+
+class VirtualClusterNotFoundError(FieldctlError):
+    pass
+
+
+class SnapshotNotFoundError(FieldctlError):
+    pass
+
+
+class WaitTimeoutError(FieldctlError):
+    pass
@@ -0,0 +1,207 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from helpers.exceptions import CommandError, FieldctlError
+
+logger = logging.getLogger('root')
+
+# Hostname the clusters use to pull from the local registry. See `registry/registries.yaml`
+LOCAL_REGISTRY_HOST = "local.registry.io"
+MANIFEST_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar"
+GZIP_LAYER_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT_SECONDS = 300
+
+
+def split_reference(reference):
+    """`ghcr.io/org/app:1.0` -> (`org/app`, `1.0`). The registry of the reference is dropped"""
+    name, _, tag = reference.rpartition(":")
+    if not name or "/" in tag:
+        name, tag = reference, "latest"
+    parts = name.split("/")
+    if len(parts) > 1 and ("." in parts[0] or ":" in parts[0] or parts[0] == "localhost"):
+        parts = parts[1:]
+    if parts[0] == "library" and len(parts) > 1:
+        parts = parts[1:]
+    return "/".join(parts), tag
+
+def _request(url, method="GET", data=None, headers=None):
+    request = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    return urllib.request.urlopen(request, timeout=TIMEOUT_SECONDS)
+
+def _blob_media_type(archive, member):
+    with tarfile.open(archive) as tar:
+        magic = tar.extractfile(member).read(2)
+    return GZIP_LAYER_MEDIA_TYPE if magic == b"\x1f\x8b" else LAYER_MEDIA_TYPE
+
+def _describe_blob(archive, member, media_type=None):
+    # Newer archives name the blobs by digest. Older ones need a pass to compute it
+    with tarfile.open(archive) as tar:
+        info = tar.getmember(member)
+        name = os.path.basename(member)
+        if member.startswith("blobs/sha256/"):
+            digest = f"sha256:{name}"
+        else:
+            sha256 = hashlib.sha256()
+            file = tar.extractfile(info)
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                sha256.update(chunk)
+            digest = f"sha256:{sha256.hexdigest()}"
+    return {
+        "mediaType": media_type or _blob_media_type(archive, member),
+        "size": info.size,
+        "digest": digest,
+        "member": member,
+    }
+
+def read_archive(archive):
+    """Images of an archive created with `docker save` (or nerdctl/podman). Returns (reference, config, layers)"""
+    with tarfile.open(archive) as tar:
+        try:
+            manifest = json.load(tar.extractfile("manifest.json"))
+        except KeyError:
+            raise FieldctlError(f"{archive} is not an image archive. Create it with `docker save`")
+    images = []
+    for image in manifest:
+        config = _describe_blob(archive, image["Config"], CONFIG_MEDIA_TYPE)
+        layers = [_describe_blob(archive, layer) for layer in image["Layers"]]
+        for reference in image.get("RepoTags") or []:
+            images.append((reference, config, layers))
+    return images
+
+
+class Pusher:
+    """Push images to a registry. Blobs already in the registry, or pushed by another image, are not sent again"""
+
+    def __init__(self, registry):
+        self.registry = f"http://{registry}"
+        self.bytes_transferred = 0
+        self.pushed_blobs = 0
+        self.skipped_blobs = 0
+        self._lock = threading.Lock()
+        # digest -> future of the repository which has the blob
+        self._blobs = {}
+        self._catalog = None
+
+    def _blob_exist(self, repository, digest):
+        try:
+            _request(f"{self.registry}/v2/{repository}/blobs/{digest}", method="HEAD")
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def _find_blob(self, repository, digest):
+        # The registry checks the blobs per repository. Look for it in the repository and then in the others
+        if self._blob_exist(repository, digest):
+            return repository
+        with self._lock:
+            if self._catalog is None:
+                with _request(f"{self.registry}/v2/_catalog?n=10000") as response:
+                    self._catalog = json.load(response).get("repositories") or []
+            catalog = list(self._catalog)
+        for other in catalog:
+            if other != repository and self._blob_exist(other, digest):
+                return other
+        return None
+
+    def _mount(self, repository, digest, source):
+        """Returns None when the blob is mounted. Otherwise the registry started an upload, its location is returned"""
+        query = urllib.parse.urlencode({"mount": digest, "from": source})
+        with _request(f"{self.registry}/v2/{repository}/blobs/uploads/?{query}", method="POST", data=b"") as response:
+            if response.status == 201:
+                return None
+            return urllib.parse.urljoin(self.registry, response.headers["Location"])
+
+    def _upload(self, repository, archive, blob, location=None):
+        if location is None:
+            with _request(f"{self.registry}/v2/{repository}/blobs/uploads/", method="POST", data=b"") as response:
+                location = urllib.parse.urljoin(self.registry, response.headers["Location"])
+        separator = "&" if "?" in location else "?"
+        with tarfile.open(archive) as tar:
+            file = tar.extractfile(blob["member"])
+            _request(
+                f"{location}{separator}digest={urllib.parse.quote(blob['digest'])}",
+                method="PUT",
+                data=file,
+                headers={"Content-Type": "application/octet-stream", "Content-Length": str(blob["size"])},
+            ).close()
+
+    def _send_blob(self, repository, archive, blob, source=None):
+        # Mount the blob from the repository which has it. Upload it when there is none or the mount is refused
+        location = None
+        if source is not None:
+            location = self._mount(repository, blob["digest"], source)
+            if location is None:
+                with self._lock:
+                    self.skipped_blobs += 1
+                return
+        self._upload(repository, archive, blob, location)
+        with self._lock:
+            self.pushed_blobs += 1
+            self.bytes_transferred += blob["size"]
+
+    def _push_blob(self, repository, archive, blob):
+        digest = blob["digest"]
+        with self._lock:
+            future = self._blobs.get(digest)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._blobs[digest] = future
+        if not owner:
+            # Another image is pushing the same blob. Wait for it and mount it
+            source = future.result()
+            if source != repository and not self._blob_exist(repository, digest):
+                self._send_blob(repository, archive, blob, source)
+            else:
+                with self._lock:
+                    self.skipped_blobs += 1
+            return
+        try:
+            source = self._find_blob(repository, digest)
+            if source == repository:
+                with self._lock:
+                    self.skipped_blobs += 1
+            else:
+                self._send_blob(repository, archive, blob, source)
+            future.set_result(repository)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+    def push(self, archive, reference, config, layers):
+        """Push the image and return the reference to pull it from the clusters"""
+        repository, tag = split_reference(reference)
+        for blob in [config] + layers:
+            self._push_blob(repository, archive, blob)
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_MEDIA_TYPE,
+            "config": {key: config[key] for key in ["mediaType", "size", "digest"]},
+            "layers": [{key: layer[key] for key in ["mediaType", "size", "digest"]} for layer in layers],
+        }
+        data = json.dumps(manifest).encode()
+        try:
+            _request(
+                f"{self.registry}/v2/{repository}/manifests/{tag}",
+                method="PUT",
+                data=data,
+                headers={"Content-Type": MANIFEST_MEDIA_TYPE},
+            ).close()
+        except urllib.error.HTTPError as e:
+            raise CommandError(f"Error pushing the manifest of {reference}", e.code, e.read().decode())
+        with self._lock:
+            self.bytes_transferred += len(data)
+        return f"{LOCAL_REGISTRY_HOST}/{repository}:{tag}"
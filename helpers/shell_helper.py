@@ -9,8 +9,15 @@ import click_log
 logger = logging.getLogger('root')
 
 
-def run_command(command, env=os.environ.copy(), show_output=False):
+# Binaries already found in the PATH. `fieldctl serve` keeps them between requests
+_found_binaries = set()
+
+
+def run_command(command, env=None, show_output=False):
     logger.debug(f"Running command:\n{command}")
+    # Read the environment on each call. `fieldctl serve` runs the commands with the environment of the client
+    if env is None:
+        env = os.environ.copy()
     if not show_output:
         process = subprocess.run(shlex.split(command), env=env, text=True, capture_output=True)
         returncode = process.returncode
@@ -26,6 +33,15 @@ def run_command(command, env=os.environ.copy(), show_output=False):
     logger.debug(f'RETURNCODE: {returncode}\nSTDOUT:\n{strip_ansi(stdout)}\nSTDERR:\n{strip_ansi(stderr)}')
     return returncode, stderr if stderr else stdout
 
+def binary_exist(binary):
+    if binary in _found_binaries:
+        return True
+    returncode, _ = run_command(f"which {binary}")
+    if returncode != 0:
+        return False
+    _found_binaries.add(binary)
+    return True
+
 def get_process_output(process):
     time.sleep(1)
     while True:
@@ -0,0 +1,160 @@
+import datetime
+import logging
+import os
+import re
+import shutil
+
+import yaml
+import helpers.shell_helper as sh
+from helpers.exceptions import CommandError, FieldctlError
+
+logger = logging.getLogger('root')
+
+SNAPSHOTS_FOLDER = "snapshots"
+METADATA_FILE = "snapshot.yaml"
+# The vcluster keeps its state (k3s datastore and certificates) in the volume of the statefulset
+DATA_PATH = "/data"
+# Default storage size of the vcluster chart
+DATA_SIZE = "5Gi"
+HELPER_IMAGE = "busybox:1.34"
+TIMEOUT_SECONDS = 300
+# Snapshot names are folders of the persisted folder. Same rules as the names of the vclusters (DNS-1123 label)
+NAME_PATTERN = r"[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?"
+
+
+def validate_name(snapshot):
+    if not isinstance(snapshot, str) or not re.fullmatch(NAME_PATTERN, snapshot):
+        raise FieldctlError(
+            f"Invalid snapshot name {snapshot!r}. Use lowercase letters, digits and '-' (at most 63 characters)"
+        )
+
+def get_snapshot_path(persisted_folder, snapshot):
+    validate_name(snapshot)
+    return os.path.join(persisted_folder, SNAPSHOTS_FOLDER, snapshot)
+
+def snapshot_exist(persisted_folder, snapshot):
+    return os.path.isfile(os.path.join(get_snapshot_path(persisted_folder, snapshot), METADATA_FILE))
+
+def list_snapshots(persisted_folder):
+    folder = os.path.join(persisted_folder, SNAPSHOTS_FOLDER)
+    if not os.path.isdir(folder):
+        return []
+    # Skip the `.tmp` folders of the snapshots in progress
+    return sorted(
+        i for i in os.listdir(folder) if re.fullmatch(NAME_PATTERN, i) and snapshot_exist(persisted_folder, i)
+    )
+
+def _kubectl(ctx, args, error):
+    return_code, out = sh.run_command(f"kubectl --context {ctx['MAIN_CONTEXT']} {args}")
+    if return_code != 0:
+        raise CommandError(error, return_code, out)
+    return out
+
+def _apply(ctx, name, manifests, error):
+    manifests_file = f"/tmp/vcluster-snapshot-{name}.yaml"
+    with open(manifests_file, "w") as file:
+        yaml.dump_all(manifests, file, default_flow_style=False)
+    _kubectl(ctx, f"apply -f {manifests_file}", error)
+
+def _data_pvc(name):
+    # Name given by the volumeClaimTemplate of the vcluster statefulset
+    return f"data-{name}-0"
+
+def data_exist(ctx, name):
+    return_code, out = sh.run_command(
+        f"kubectl --context {ctx['MAIN_CONTEXT']} -n {name} get pvc {_data_pvc(name)} --ignore-not-found -o name"
+    )
+    if return_code != 0:
+        raise CommandError(f"Error checking the volume of the vcluster {name}", return_code, out)
+    return bool(out.strip())
+
+def _helper_pod(name):
+    return f"{name}-snapshot"
+
+def _scale(ctx, name, replicas):
+    logger.info(f"Scale vcluster {name} to {replicas} replicas")
+    _kubectl(ctx, f"-n {name} scale statefulset {name} --replicas={replicas}", f"Error scaling the vcluster {name}")
+    if replicas == 0:
+        _kubectl(ctx, f"-n {name} wait --for=delete pod/{name}-0 --timeout={TIMEOUT_SECONDS}s", f"Timeout stopping the vcluster {name}")
+    else:
+        _kubectl(ctx, f"-n {name} rollout status statefulset {name} --timeout={TIMEOUT_SECONDS}s", f"Timeout starting the vcluster {name}")
+
+def _start_helper_pod(ctx, name):
+    # The volume can only be read while the vcluster is stopped. A helper pod mounts it instead
+    pod = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": _helper_pod(name), "namespace": name},
+        "spec": {
+            "containers": [{
+                "name": "snapshot",
+                "image": HELPER_IMAGE,
+                "command": ["sleep", "3600"],
+                "volumeMounts": [{"name": "data", "mountPath": DATA_PATH}],
+            }],
+            "volumes": [{"name": "data", "persistentVolumeClaim": {"claimName": _data_pvc(name)}}],
+        },
+    }
+    _apply(ctx, name, [pod], "Error creating the snapshot helper pod")
+    _kubectl(
+        ctx,
+        f"-n {name} wait --for=condition=Ready pod/{_helper_pod(name)} --timeout={TIMEOUT_SECONDS}s",
+        "Timeout waiting for the snapshot helper pod",
+    )
+
+def _stop_helper_pod(ctx, name):
+    sh.run_command(f"kubectl --context {ctx['MAIN_CONTEXT']} -n {name} delete pod {_helper_pod(name)} --wait=true")
+
+def save(ctx, name, snapshot_path):
+    """Copy the data of the vcluster into snapshot_path. The vcluster is stopped meanwhile to get a consistent copy"""
+    tmp_path = f"{snapshot_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    _scale(ctx, name, 0)
+    try:
+        _start_helper_pod(ctx, name)
+        logger.info(f"Copy the data of vcluster {name} to {snapshot_path}")
+        _kubectl(ctx, f"cp {name}/{_helper_pod(name)}:{DATA_PATH} {tmp_path}/data", "Error copying the vcluster data")
+    finally:
+        _stop_helper_pod(ctx, name)
+        _scale(ctx, name, 1)
+    with open(os.path.join(tmp_path, METADATA_FILE), "w") as file:
+        yaml.dump({
+            "source": name,
+            "main_context": ctx["MAIN_CONTEXT"],
+            "created": datetime.datetime.now().isoformat(),
+        }, file, default_flow_style=False)
+    # Replace the previous snapshot only when the new one is complete
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    os.rename(tmp_path, snapshot_path)
+
+def restore(ctx, name, snapshot_path):
+    """Create the volume of a new vcluster with the data of the snapshot. Run it before creating the vcluster"""
+    # `kubectl apply` would accept an existing volume and the data of a running vcluster would be overwritten
+    if data_exist(ctx, name):
+        raise FieldctlError(
+            f"The volume {_data_pvc(name)} already exists in namespace {name}. Delete the vcluster or choose another name"
+        )
+    namespace = {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": name}}
+    pvc = {
+        "apiVersion": "v1",
+        "kind": "PersistentVolumeClaim",
+        "metadata": {"name": _data_pvc(name), "namespace": name},
+        "spec": {
+            "accessModes": ["ReadWriteOnce"],
+            "resources": {"requests": {"storage": DATA_SIZE}},
+        },
+    }
+    _apply(ctx, name, [namespace, pvc], "Error creating the volume of the vcluster")
+    _start_helper_pod(ctx, name)
+    try:
+        logger.info(f"Copy the data of {snapshot_path} to vcluster {name}")
+        # `kubectl cp` nests the folder if the destination exists. Copy it aside and move its content
+        _kubectl(ctx, f"cp {snapshot_path}/data {name}/{_helper_pod(name)}:/restore", "Error copying the snapshot data")
+        _kubectl(
+            ctx,
+            f"-n {name} exec {_helper_pod(name)} -- sh -c 'cp -a /restore/. {DATA_PATH}/ && rm -rf /restore'",
+            "Error restoring the snapshot data",
+        )
+    finally:
+        _stop_helper_pod(ctx, name)
@@ -1,6 +1,9 @@
+import copy
+import datetime
 import json
 import logging
 import os
+import re
 import shutil
 import sys
 import yaml
@@ -12,21 +15,119 @@ logger = logging.getLogger('root')
 PROVISION_FOLDER = "provision"
 HOME_VAR_NAME = "FIELDCTL_HOME"
 LIMA_CONFIG_TEMPLATE = "lima-vm.yaml.template"
+REGISTRY_DATA_VAR_NAME = "FIELDCTL_REGISTRY_DATA"
+
+# Mount type and mount cache settings for the persisted folder. See https://github.com/lima-vm/lima/blob/master/docs/mount.md
+IO_PROFILES = {
+    "default": {"mountType": "reverse-sshfs", "mount": {"sshfs": {"cache": True}}},
+    "9p": {"mountType": "9p", "mount": {"9p": {"cache": "mmap", "msize": "128KiB"}}},
+    # virtiofs is only available with the Virtualization.framework (macOS >= 13)
+    "virtiofs": {"vmType": "vz", "mountType": "virtiofs", "mount": {}},
+}
+REGISTRY_STORAGES = ["host", "guest"]
+# Containers started by `deploy-caches.sh`
+REGISTRY_CONTAINERS = ["k3s-cache-docker", "k3s-cache-gcr", "k3s-cache-k8s", "k3s-cache-quay", "k3s-local-registry"]
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Output of `limactl ls`: (state of the Lima folders, VMs). Reused while the folders do not change (i.e. `fieldctl serve`)
+_vms = None
 
 def copy_persisted_folder(provision_folder, persisted_folder):
     shutil.copytree(
         f"{provision_folder}", f"{persisted_folder}", dirs_exist_ok=True
     )
     
-def vm_exist(vm_name):
-    _, out = sh.run_command(f"limactl ls --json")
+def _lima_state():
+    # Lima creates and removes the pid files and sockets of an instance when it starts and stops
+    lima_home = os.environ.get("LIMA_HOME") or os.path.join(os.environ["HOME"], ".lima")
+    try:
+        instances = [os.path.join(lima_home, i) for i in sorted(os.listdir(lima_home))]
+        return [lima_home, os.stat(lima_home).st_mtime_ns] + [
+            (i, os.stat(i).st_mtime_ns) for i in instances if os.path.isdir(i)
+        ]
+    except OSError:
+        return None
+
+def get_vms(use_cache=True):
+    """VMs of `limactl ls`.
+
+    With use_cache, the previous result is returned while the Lima folders do not change. A VM which crashes
+    without cleaning its folder is still reported as running. Disable it to poll the status
+    """
+    global _vms
+    state = _lima_state()
+    if use_cache and state is not None and _vms is not None and _vms[0] == state:
+        return copy.deepcopy(_vms[1])
+    # `limactl ls --json` prints one json object per line
+    returncode, out = sh.run_command(f"limactl ls --json")
     out = ",".join(out.strip().split("\n"))
     out = "[" + out + "]"
     vms = json.loads(out)
-    exist = len([i for i in vms if i["name"] == vm_name])
+    if returncode == 0 and state is not None:
+        _vms = (state, vms)
+    return vms
+
+def vm_exist(vm_name):
+    exist = len([i for i in get_vms() if i["name"] == vm_name])
     return True if exist else False
 
 
+def run_persisted_script(vm_name, script):
+    # Scripts are run from the persisted folder, which is `$FIELDCTL_HOME` in the VM
+    return sh.run_command(
+        f"limactl shell --workdir='/' {vm_name} sh -c 'cd $FIELDCTL_HOME; ./{script}'"
+    )
+
+def caches_running(vm_name):
+    returncode, out = sh.run_command(
+        f"limactl shell --workdir='/' {vm_name} nerdctl ps --format '{{{{.Names}}}}'"
+    )
+    if returncode != 0:
+        return False
+    running = out.split()
+    return all(container in running for container in REGISTRY_CONTAINERS)
+
+def parse_size(value):
+    # i.e. 500M, 20G, 20GiB or a number of bytes
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?", value.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}. Expected a number with an optional unit, i.e. 20G")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+def parse_duration(value):
+    # i.e. 12h, 30d, 2w. Returns seconds
+    match = re.fullmatch(r"(\d+)\s*([smhdw])", value.strip())
+    if not match:
+        raise ValueError(f"Invalid duration: {value}. Expected a number with a unit (s, m, h, d, w), i.e. 30d")
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+def get_cache_stats(vm_name):
+    returncode, out = run_persisted_script(vm_name, "manage-caches.sh stats")
+    if returncode != 0:
+        return returncode, out
+    stats = []
+    for line in out.strip().splitlines():
+        name, size, blobs, last_access = line.split()
+        stats.append({
+            "name": name,
+            "size": int(size),
+            "blobs": int(blobs),
+            "last_access": datetime.datetime.fromtimestamp(int(last_access)) if int(last_access) else None,
+        })
+    return returncode, stats
+
+def prune_caches(vm_name, max_size=0, older_than=0):
+    # Registries are stopped while evicting and garbage collecting
+    return run_persisted_script(vm_name, f"manage-caches.sh prune {max_size} {older_than}")
+
 def get_path_to_provision(base_path):
     provision_path = os.path.join(base_path, PROVISION_FOLDER)
     return provision_path
@@ -35,14 +136,30 @@ def get_path_to_lima_template(base_path):
     path = os.path.join(base_path, PROVISION_FOLDER, LIMA_CONFIG_TEMPLATE)
     return path
 
-def add_home_persisted_folder(ctx, config):
-    logger.info(f"Adding persisted volume {ctx['PERSISTED_FOLDER']} to {config}")
+def add_home_persisted_folder(ctx, config, io_profile="default"):
+    logger.info(f"Adding persisted volume {ctx['PERSISTED_FOLDER']} to {config} with io profile {io_profile}")
+    profile = IO_PROFILES[io_profile]
     with open(config) as file:
         data = yaml.load(file, Loader=yaml.FullLoader)
-    data["mounts"].append({"location": ctx["PERSISTED_FOLDER"], "writable": True})
+    if "vmType" in profile:
+        data["vmType"] = profile["vmType"]
+    data["mountType"] = profile["mountType"]
+    data["mounts"].append({"location": ctx["PERSISTED_FOLDER"], "writable": True, **profile["mount"]})
     data["env"][HOME_VAR_NAME] = ctx["PERSISTED_FOLDER"]
     with open(config, "w") as file:
         yaml.dump(data, file)
+
+def set_registry_storage(ctx, config, registry_storage):
+    # With guest storage the registries write into the VM disk instead of the (slower) mounted persisted folder
+    if registry_storage != "guest":
+        return
+    logger.info(f"Registry data will be stored in the VM at {ctx['GUEST_REGISTRY_FOLDER']}")
+    with open(config) as file:
+        data = yaml.load(file, Loader=yaml.FullLoader)
+    data["env"][REGISTRY_DATA_VAR_NAME] = ctx["GUEST_REGISTRY_FOLDER"]
+    with open(config, "w") as file:
+        yaml.dump(data, file)
+
 def update_allocated_resources(ctx, config, cpus, disk, memory):
     logger.info(f"Updating cpu to {cpus}")
     with open(config) as file:
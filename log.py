@@ -2,9 +2,10 @@ import logging
 import coloredlogs
 
 def setup_custom_logger(name, loglevel):
-    handler = logging.StreamHandler()
     logger = logging.getLogger(name)
-    logger.addHandler(handler)
+    # coloredlogs replaces this handler. Adding it again (i.e. on every request of `fieldctl serve`) duplicates the output
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
     custom_level_styles = {
         "critical": {"bold": True, "color": "red"},
         "debug": {"color": "green"},
@@ -1,10 +1,17 @@
 #!/bin/sh
 
+# Registry storage lives in the persisted folder unless the VM was created with guest-local storage
+REGISTRY_DATA="${FIELDCTL_REGISTRY_DATA:-$(pwd)/registry/data}"
+if [ ! -d "$REGISTRY_DATA" ]; then
+    sudo mkdir -p "$REGISTRY_DATA"/docker "$REGISTRY_DATA"/gcr "$REGISTRY_DATA"/k8s "$REGISTRY_DATA"/quay "$REGISTRY_DATA"/local-registry
+    sudo chown -R "$(id -u):$(id -g)" "$REGISTRY_DATA"
+fi
+
 nerdctl rm -f k3s-cache-docker || true
 nerdctl run -d \
     --restart=always \
     -v $(pwd)/registry/config-docker.yml:/etc/docker/registry/config.yml \
-    -v $(pwd)/registry/data/docker:/var/lib/registry \
+    -v $REGISTRY_DATA/docker:/var/lib/registry \
     -p 5001:5000 \
     --name "k3s-cache-docker" registry:2
 
@@ -12,7 +19,7 @@ nerdctl rm -f k3s-cache-gcr || true
 nerdctl run -d \
     --restart=always \
     -v $(pwd)/registry/config-gcr.yml:/etc/docker/registry/config.yml \
-    -v $(pwd)/registry/data/gcr:/var/lib/registry \
+    -v $REGISTRY_DATA/gcr:/var/lib/registry \
     -p 5002:5000 \
     --name "k3s-cache-gcr" registry:2
 
@@ -20,7 +27,7 @@ nerdctl rm -f k3s-cache-k8s || true
 nerdctl run -d \
     --restart=always \
     -v $(pwd)/registry/config-k8s.yml:/etc/docker/registry/config.yml \
-    -v $(pwd)/registry/data/k8s:/var/lib/registry \
+    -v $REGISTRY_DATA/k8s:/var/lib/registry \
     -p 5003:5000 \
     --name "k3s-cache-k8s" registry:2
 
@@ -28,14 +35,14 @@ nerdctl rm -f k3s-cache-quay || true
 nerdctl run -d \
     --restart=always \
     -v $(pwd)/registry/config-quay.yml:/etc/docker/registry/config.yml \
-    -v $(pwd)/registry/data/quay:/var/lib/registry \
+    -v $REGISTRY_DATA/quay:/var/lib/registry \
     -p 5004:5000 \
     --name "k3s-cache-quay" registry:2
 
 nerdctl rm -f k3s-local-registry || true
 nerdctl run -d \
     --restart=always \
-    -v $(pwd)/registry/data/local-registry:/var/lib/registry \
+    -v $REGISTRY_DATA/local-registry:/var/lib/registry \
     -p 5005:5000 \
     --name "k3s-local-registry" registry:2
 
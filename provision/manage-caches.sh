@@ -0,0 +1,105 @@
+#!/bin/sh
+
+# Inspect and evict the data of the registry caches.
+# Usage:
+#   ./manage-caches.sh stats                           -- prints: <registry> <bytes> <blobs> <last access epoch>
+#   ./manage-caches.sh prune <max bytes> <max age secs> -- LRU eviction of layer blobs in the mirrors. 0 disables a limit
+#   ./manage-caches.sh gc                              -- registry garbage collection with the registries stopped
+REGISTRY_DATA="${FIELDCTL_REGISTRY_DATA:-$(pwd)/registry/data}"
+MIRRORS="docker gcr k8s quay"
+V2=docker/registry/v2
+
+blobs() {
+    # <atime> <bytes> <blob dir> for every blob of the given registries
+    for name in "$@"; do
+        [ -d "$REGISTRY_DATA/$name/$V2/blobs" ] || continue
+        find "$REGISTRY_DATA/$name/$V2/blobs" -type f -name data -printf "%A@ %s %h\n"
+    done
+}
+
+stats() {
+    for name in $MIRRORS local-registry; do
+        blobs $name | awk -v name=$name '
+            { size += $2; count++; if ($1 > last) last = $1 }
+            END { printf "%s %.0f %d %.0f\n", name, size, count, last }'
+    done
+}
+
+prune() {
+    MAX_BYTES=$1
+    MAX_AGE=$2
+    NOW=$(date +%s)
+    for name in $MIRRORS; do
+        nerdctl stop k3s-cache-$name > /dev/null 2>&1 || true
+    done
+    # Manifests are never evicted. Only layers, which the mirrors fetch again from upstream when needed
+    MANIFESTS=$(mktemp)
+    for name in $MIRRORS; do
+        [ -d "$REGISTRY_DATA/$name/$V2/repositories" ] || continue
+        find "$REGISTRY_DATA/$name/$V2/repositories" -type d -path "*/_manifests/revisions/sha256/*" -printf "%f\n"
+    done | sort -u > $MANIFESTS
+    blobs $MIRRORS | sort -n | awk -v max_bytes=$MAX_BYTES -v max_age=$MAX_AGE -v now=$NOW -v manifests=$MANIFESTS '
+        BEGIN { while ((getline d < manifests) > 0) keep[d] = 1 }
+        { total += $2; n = split($3, p, "/"); if (p[n] in keep) next; atime[NR] = $1; size[NR] = $2; dir[NR] = $3 }
+        END {
+            for (i = 1; i <= NR; i++) {
+                if (!(i in dir)) continue
+                old = max_age > 0 && now - atime[i] > max_age
+                big = max_bytes > 0 && total > max_bytes
+                if (!old && !big) continue
+                print dir[i]
+                total -= size[i]
+            }
+        }' | while read dir; do
+        rm -rf "$dir"
+        echo "$dir"
+    done | wc -l | xargs echo "Evicted blobs:"
+    rm -f $MANIFESTS
+    # Remove the repository links to the evicted blobs so that the mirrors fetch them again
+    for name in $MIRRORS; do
+        [ -d "$REGISTRY_DATA/$name/$V2/repositories" ] || continue
+        find "$REGISTRY_DATA/$name/$V2/repositories" -type d -path "*/_layers/sha256/*" -prune | while read link; do
+            digest=$(basename $link)
+            [ -d "$REGISTRY_DATA/$name/$V2/blobs/sha256/$(echo $digest | cut -c1-2)/$digest" ] || rm -rf "$link"
+        done
+    done
+}
+
+gc() {
+    # The registries must not serve requests while garbage collecting
+    RESULT=0
+    for name in $MIRRORS local-registry; do
+        if [ $name = local-registry ]; then
+            container=k3s-local-registry
+            config=""
+        else
+            container=k3s-cache-$name
+            config="-v $(pwd)/registry/config-$name.yml:/etc/docker/registry/config.yml"
+        fi
+        nerdctl stop $container > /dev/null 2>&1 || true
+        if ! nerdctl run --rm $config -v $REGISTRY_DATA/$name:/var/lib/registry \
+            registry:2 garbage-collect /etc/docker/registry/config.yml > /dev/null 2>&1; then
+            echo "Garbage collection failed for $name" >&2
+            RESULT=1
+        fi
+        nerdctl start $container > /dev/null 2>&1
+    done
+    return $RESULT
+}
+
+case "$1" in
+    stats)
+        stats
+        ;;
+    prune)
+        prune "${2:-0}" "${3:-0}"
+        gc
+        ;;
+    gc)
+        gc
+        ;;
+    *)
+        echo "Usage: $0 stats|prune <max bytes> <max age seconds>|gc"
+        exit 1
+        ;;
+esac
@@ -0,0 +1,35 @@
+#!/bin/sh
+
+# Copy the registry data between the guest-local disk and the persisted folder.
+# Usage: ./sync-caches.sh export|import
+HOST_DATA="$(pwd)/registry/data"
+REGISTRY_DATA="${FIELDCTL_REGISTRY_DATA:-$HOST_DATA}"
+REGISTRIES="k3s-cache-docker k3s-cache-gcr k3s-cache-k8s k3s-cache-quay k3s-local-registry"
+
+if [ "$REGISTRY_DATA" = "$HOST_DATA" ]; then
+    echo "Registry storage is already the persisted folder. Nothing to sync"
+    exit 0
+fi
+
+case "$1" in
+    export)
+        SRC="$REGISTRY_DATA"
+        DST="$HOST_DATA"
+        ;;
+    import)
+        SRC="$HOST_DATA"
+        DST="$REGISTRY_DATA"
+        ;;
+    *)
+        echo "Usage: $0 export|import"
+        exit 1
+        ;;
+esac
+
+# Stop the registries so that no blob is written while copying
+nerdctl stop $REGISTRIES || true
+mkdir -p "$DST"
+cp -a "$SRC/." "$DST/"
+RESULT=$?
+nerdctl start $REGISTRIES
+exit $RESULT
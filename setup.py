@@ -11,7 +11,7 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'fieldctl = cli:cli',
+            'fieldctl = cli:main',
         ],
     },
 )
\ No newline at end of file